@@ -1,19 +1,60 @@
 import asyncio
+import click
 from datasette import hookimpl, Response, NotFound, Forbidden
 from datasette.permissions import Action
 from datasette.resources import DatabaseResource, TableResource
-from datetime import datetime, timezone
-from sqlite_utils import Database
-import ijson
+from datasette.utils import escape_sqlite
+from datetime import datetime, timedelta, timezone
+import importlib
 import json
-from llm import Attachment
-import ulid
-import urllib
-
-__all__ = ("remove_null_bytes",)
+import os
+import random
+import re
+import time
+import zlib
+
+__all__ = (
+    "BatchBackend",
+    "LocalFileBatchBackend",
+    "remove_null_bytes",
+    "submit_extract_batch",
+)
 
 PURPOSE = "extract"
 
+# Defaults for retrying a failed model stream, see get_config()
+DEFAULT_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 1.0
+DEFAULT_RETRY_MAX_BACKOFF = 30.0
+# Most recent items included in a retried prompt, see resume_prompt()
+DEFAULT_RESUME_ITEMS = 50
+
+# Seconds between checks on a submitted batch, see get_batch_backend()
+DEFAULT_BATCH_POLL_INTERVAL = 60.0
+
+# Model ID submitted by the forms to pick a model using the routing rules
+AUTO_MODEL = "auto"
+
+# Compressed raw model output, see OutputSpool and replay_extract_output()
+OUTPUT_TABLE = "_datasette_extract_output"
+
+# Job queue used by out-of-process workers, see run_extract_worker()
+JOBS_TABLE = "_datasette_extract_jobs"
+DEFAULT_WORKER_POLL_INTERVAL = 1.0
+# Seconds without a heartbeat before another worker can claim a running job
+DEFAULT_JOB_LEASE = 60.0
+# How many of the most recent items a worker reports back for the progress page
+PROGRESS_ITEMS = 20
+
+# Most rows the progress page keeps around for display, see extract_progress.html
+PROGRESS_MAX_ROWS = 1000
+
+# How many recent items a running task keeps in memory in task_info["items"]
+PREVIEW_ITEMS = 100
+
+# Files with these extensions are sent to the model as image attachments
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp")
+
 
 @hookimpl
 def register_actions(datasette):
@@ -66,6 +107,36 @@ async def can_extract(datasette, actor, database_name, to_table=None):
         )
 
 
+def properties_from_post(post_vars, prefix=""):
+    properties = {}
+    # Build the properties out of name_0 upwards, only if populated
+    name_prefix = "{}name_".format(prefix)
+    for key, value in post_vars.items():
+        if key.startswith(name_prefix) and value.strip():
+            index = int(key[len(name_prefix) :])
+            type_ = post_vars.get("{}type_{}".format(prefix, index))
+            hint = post_vars.get("{}hint_{}".format(prefix, index))
+            properties[value] = {
+                "type": type_,
+            }
+            if hint:
+                properties[value]["description"] = hint
+    return properties
+
+
+def child_tables(properties):
+    """
+    Properties that are arrays of objects, each of which are written to a child
+    table of that name. Returns a dict of name -> properties of the child.
+    """
+    return {
+        name: prop["items"]["properties"]
+        for name, prop in properties.items()
+        if prop.get("type") == "array"
+        and (prop.get("items") or {}).get("type") == "object"
+    }
+
+
 def image_is_provided(image):
     # UploadFile(filename='', size=0, headers=Headers...
     return image and bool(image.size)
@@ -94,18 +165,30 @@ async def extract_create_table(datasette, request):
 
         model_id = post_vars["model"]
 
-        properties = {}
-        # Build the properties out of name_0 upwards, only if populated
-        for key, value in post_vars.items():
-            if key.startswith("name_") and value.strip():
-                index = int(key.split("_")[1])
-                type_ = post_vars.get("type_{}".format(index))
-                hint = post_vars.get("hint_{}".format(index))
-                properties[value] = {
-                    "type": type_,
-                }
-                if hint:
-                    properties[value]["description"] = hint
+        properties = properties_from_post(post_vars)
+        # Optional child table, extracted as an array of objects on each row
+        child_table = (post_vars.get("child_table") or "").strip()
+        child_properties = properties_from_post(post_vars, prefix="child_")
+        if child_table and child_properties:
+            if child_table == table or child_table in properties:
+                return Response.text(
+                    "Child table name must differ from the table and its columns",
+                    status=400,
+                )
+            if "id" in properties:
+                return Response.text(
+                    "The id column is used to link to the child table, "
+                    "use a different column name",
+                    status=400,
+                )
+            properties[child_table] = {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": child_properties,
+                    "required": list(child_properties.keys()),
+                },
+            }
 
         return await extract_to_table_post(
             datasette,
@@ -117,6 +200,7 @@ async def extract_create_table(datasette, request):
             database,
             table,
             properties,
+            mode=post_vars.get("mode"),
         )
 
     fields = []
@@ -145,6 +229,8 @@ async def extract_create_table(datasette, request):
                 "database": database,
                 "fields": fields,
                 "models": models,
+                "routing_enabled": bool(get_config(datasette).get("routing")),
+                "batch_enabled": get_batch_backend(datasette) is not None,
             },
             request=request,
         )
@@ -152,6 +238,9 @@ async def extract_create_table(datasette, request):
 
 
 async def extract_to_table(datasette, request):
+    from sqlite_utils import Database
+    from urllib.parse import urlencode
+
     database = request.url_vars["database"]
     table = request.url_vars["table"]
     # Do they exist?
@@ -208,6 +297,7 @@ async def extract_to_table(datasette, request):
             database,
             table,
             properties,
+            mode=post_vars.get("mode"),
         )
 
     # GET request logic starts here
@@ -228,6 +318,17 @@ async def extract_to_table(datasette, request):
                 )
             ).rows
         ]
+    if previous_runs and await db.table_exists(OUTPUT_TABLE):
+        archived = {
+            row["run_id"]
+            for row in (
+                await db.execute(
+                    "select distinct run_id from {}".format(escape_sqlite(OUTPUT_TABLE))
+                )
+            ).rows
+        }
+        for run in previous_runs:
+            run["archived"] = run["id"] in archived
 
     columns = [
         {"name": name, "type": value, "hint": "", "checked": True}
@@ -250,7 +351,7 @@ async def extract_to_table(datasette, request):
     duplicate_url = (
         datasette.urls.database(database)
         + "/-/extract?"
-        + urllib.parse.urlencode(
+        + urlencode(
             {
                 "_fields": json.dumps(
                     [
@@ -285,41 +386,173 @@ async def extract_to_table(datasette, request):
                 "duplicate_url": duplicate_url,
                 "previous_runs": previous_runs,
                 "models": models,
+                "routing_enabled": bool(get_config(datasette).get("routing")),
+                "batch_enabled": get_batch_backend(datasette) is not None,
             },
             request=request,
         )
     )
 
 
-async def extract_table_task(
-    datasette,
-    model_id,
-    database,
-    table,
-    properties,
-    instructions,
-    content,
-    image,
-    task_id,
-):
-    # This task runs in the background and writes to the table as it extracts rows
-    events = ijson.sendable_list()
-    coro = ijson.items_coro(events, "items.item", use_float=True)
-    seen_events = set()
-    items = []
+def import_string(path):
+    # "module.name:attribute" to the object it refers to
+    module_name, _, attribute = path.partition(":")
+    return getattr(importlib.import_module(module_name), attribute)
 
-    datasette._extract_tasks = getattr(datasette, "_extract_tasks", None) or {}
-    task_info = {
-        "items": items,
-        "database": database,
-        "model": model_id,
-        "table": table,
-        "instructions": instructions,
-        "properties": properties,
-        "error": None,
-        "done": False,
+
+def collapse_whitespace(text):
+    """
+    Collapse runs of spaces and tabs, strip trailing whitespace from each line and
+    reduce three or more newlines to a single blank line.
+    """
+    text = re.sub(r"[ \t\f\v\u00a0]+", " ", text)
+    text = re.sub(r" *\n *", "\n", text)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+QUOTED_HEADER_RE = re.compile(r"^\s*On .{1,200} wrote:\s*$")
+
+
+def strip_quoted_text(text):
+    """
+    Remove quoted replies from email threads: "> " prefixed lines and the
+    "On ... wrote:" lines that introduce them.
+    """
+    return "\n".join(
+        line
+        for line in text.split("\n")
+        if not line.lstrip().startswith(">") and not QUOTED_HEADER_RE.match(line)
+    )
+
+
+BOILERPLATE_LINE_RES = [
+    re.compile(pattern, re.IGNORECASE)
+    for pattern in (
+        r"^\s*sent from my \w+.*$",
+        r"^\s*page \d+( of \d+)?\s*$",
+        r"^\s*(click here to |to |you can )?unsubscribe\b.*$",
+        r"^\s*(get outlook for|download outlook for) .*$",
+    )
+]
+
+
+# A "-- " signature delimiter further from the end than this is not a signature
+SIGNATURE_MAX_LINES = 10
+
+
+def strip_boilerplate(text):
+    """
+    Remove email signatures (everything after a "-- " line close to the end of
+    the text) and common footer lines such as "Sent from my iPhone", "Page 3 of
+    10" and "Unsubscribe" links.
+    """
+    lines = text.split("\n")
+    # Exactly "-- " with the trailing space, as a bare "--" is often data
+    for index in range(max(len(lines) - SIGNATURE_MAX_LINES - 1, 0), len(lines)):
+        if lines[index].rstrip("\r") == "-- ":
+            lines = lines[:index]
+            break
+    return "\n".join(
+        line
+        for line in lines
+        if not any(regex.match(line) for regex in BOILERPLATE_LINE_RES)
+    )
+
+
+def remove_repeated_lines(text, min_repeats=3, min_length=8, min_gap=5):
+    """
+    Drop later copies of running headers and footers in PDF text dumps: lines of
+    at least min_length characters that appear at least min_repeats times, never
+    within min_gap lines of each other. Short values and data rows that repeat
+    close together, like identical line items, are kept.
+    """
+    lines = text.split("\n")
+    positions = {}
+    for index, line in enumerate(lines):
+        if len(line.strip()) >= min_length:
+            positions.setdefault(line.strip(), []).append(index)
+    repeated = {
+        key
+        for key, indexes in positions.items()
+        if len(indexes) >= min_repeats
+        and all(b - a >= min_gap for a, b in zip(indexes, indexes[1:]))
+    }
+    seen = set()
+    kept = []
+    for line in lines:
+        key = line.strip()
+        if key in repeated:
+            if key in seen:
+                continue
+            seen.add(key)
+        kept.append(line)
+    return "\n".join(kept)
+
+
+PREPROCESSORS = {
+    "whitespace": collapse_whitespace,
+    "quoted_text": strip_quoted_text,
+    "boilerplate": strip_boilerplate,
+    "repeated_lines": remove_repeated_lines,
+}
+
+
+def estimate_tokens(text):
+    # Rough rule of thumb of four characters per token
+    return (len(text) + 3) // 4
+
+
+def preprocess_content(content, steps):
+    """
+    Run content through each named step in turn - names from PREPROCESSORS, or
+    "module:function" paths to a function that takes and returns a string.
+    Returns the new content and a list of bytes and estimated tokens saved
+    by each step.
+    """
+    stats = []
+    for step in steps:
+        fn = PREPROCESSORS.get(step) or import_string(step)
+        before = content
+        content = fn(content)
+        stats.append(
+            {
+                "step": step,
+                "bytes_saved": len(before.encode("utf-8"))
+                - len(content.encode("utf-8")),
+                "tokens_saved": estimate_tokens(before) - estimate_tokens(content),
+            }
+        )
+    return content, stats
+
+
+def extract_schema(properties):
+    return {
+        "type": "object",
+        "description": "Extract data",
+        "properties": {
+            "items": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": properties,
+                    "required": list(properties.keys()),
+                },
+            }
+        },
+        "required": ["items"],
     }
-    datasette._extract_tasks[task_id] = task_info
+
+
+def utc_now(seconds_ago=0):
+    return (datetime.now(timezone.utc) - timedelta(seconds=seconds_ago)).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+
+
+async def record_run_start(
+    db, task_id, database, table, model_id, instructions, properties, **extra
+):
+    from sqlite_utils import Database
 
     # We record tasks to the _datasette_extract table, mainly so we can reuse
     # property definitions later on
@@ -331,16 +564,20 @@ async def extract_table_task(
                     "id": task_id,
                     "database_name": database,
                     "table_name": table,
-                    "created": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+                    "created": utc_now(),
                     "model": model_id,
                     "instructions": instructions.strip() or None,
                     "properties": json.dumps(properties),
                     "completed": None,
                     "error": None,
                     "num_items": 0,
+                    "retries": 0,
+                    **extra,
                 },
                 pk="id",
                 alter=True,
+                # A job claimed again after its worker died runs under the same ID
+                replace=True,
                 column_order=(  # Define order explicitly
                     "id",
                     "database_name",
@@ -352,11 +589,10 @@ async def extract_table_task(
                     "completed",
                     "error",
                     "num_items",
+                    "retries",
                 ),
             )
 
-    db = datasette.get_database(database)
-
     # Ensure table exists before writing
     await db.execute_write_fn(
         lambda conn: Database(conn)["_datasette_extract"].create(
@@ -371,6 +607,7 @@ async def extract_table_task(
                 "completed": str,
                 "error": str,
                 "num_items": int,
+                "retries": int,
             },
             pk="id",
             if_not_exists=True,
@@ -379,14 +616,128 @@ async def extract_table_task(
 
     await db.execute_write_fn(start_write)
 
+
+async def record_run_end(db, task_id, **updates):
+    from sqlite_utils import Database
+
+    def end_write(conn):
+        with conn:
+            db = Database(conn)
+            db["_datasette_extract"].update(
+                task_id, {"completed": utc_now(), **updates}, alter=True
+            )
+
+    await db.execute_write_fn(end_write)
+
+
+async def extract_table_task(
+    datasette,
+    model_id,
+    database,
+    table,
+    properties,
+    instructions,
+    content,
+    image,
+    task_id,
+    routing=None,
+    staging=None,
+):
+    import ijson
+    from llm import Attachment
+    from sqlite_utils import Database
+
+    # This task runs in the background and writes to the table as it extracts rows.
+    # Only the most recent items are kept in memory - older ones can be read
+    # back from the table using read_task_items(), by the runs of rowids this
+    # task wrote, as other tasks may be writing to the same table
+    seen_hashes = set()
+    items = []
+    rowid_ranges = []
+
+    config = get_config(datasette)
+    max_retries = config.get("retries", DEFAULT_RETRIES)
+    retry_backoff = config.get("retry_backoff", DEFAULT_RETRY_BACKOFF)
+    retry_max_backoff = config.get("retry_max_backoff", DEFAULT_RETRY_MAX_BACKOFF)
+    resume_items = config.get("resume_items", DEFAULT_RESUME_ITEMS)
+
+    datasette._extract_tasks = getattr(datasette, "_extract_tasks", None) or {}
+    task_info = {
+        "items": items,
+        "database": database,
+        "model": model_id,
+        "table": table,
+        "instructions": instructions,
+        "properties": properties,
+        "num_items": 0,
+        "first_rowid": None,
+        "last_rowid": None,
+        "rowid_ranges": rowid_ranges,
+        "error": None,
+        "retries": 0,
+        "preprocessing": [],
+        "routing": routing,
+        "done": False,
+    }
+    # Arrays of objects are written to child tables as they complete
+    children = child_tables(properties)
+    # In staging mode rows are streamed to a per-run table, then merged into
+    # the target table in a single transaction once extraction has succeeded.
+    # Child rows link to their parent's rowid, which a merge would change, so
+    # nested extractions always write directly.
+    write_table = table
+    if staging is None:
+        staging = config.get("staging")
+    if staging and not children:
+        write_table = staging_table_name(task_id)
+        task_info["staging_table"] = write_table
+    datasette._extract_tasks[task_id] = task_info
+
+    db = datasette.get_database(database)
+    if write_table != table:
+        # Left behind by an earlier run of this task that never finished
+        await db.execute_write_fn(
+            lambda conn: Database(conn)[write_table].drop(ignore=True)
+        )
+    await record_run_start(
+        db,
+        task_id,
+        database,
+        table,
+        model_id,
+        instructions,
+        properties,
+        routing=json.dumps(routing) if routing else None,
+    )
+
     def make_row_writer(row):
         def _write(conn):
             with conn:
-                db = Database(conn)
-                db[table].insert(row)
+                return Database(conn)[write_table].insert(row).last_rowid
 
         return _write
 
+    def record_rowid(rowid):
+        if task_info["first_rowid"] is None:
+            task_info["first_rowid"] = rowid
+        task_info["last_rowid"] = rowid
+        add_rowid(rowid_ranges, rowid)
+
+    def item_completed(item):
+        task_info["num_items"] += 1
+        items.append(remove_null_bytes(item))
+        if len(items) > PREVIEW_ITEMS:
+            del items[: len(items) - PREVIEW_ITEMS]
+
+    def nested_item_written(item, rowid):
+        record_rowid(rowid)
+        item_completed(item)
+
+    nested_writer = None
+    if children:
+        nested_writer = NestedRowWriter(db, table, children, nested_item_written)
+        task_info["num_child_items"] = nested_writer.num_child_items
+
     error = None
     from datasette_llm import LLM
 
@@ -401,141 +752,1827 @@ async def extract_table_task(
         if image_is_provided(image):
             image_bytes = await image.read()
             kwargs["attachments"] = [Attachment(content=image_bytes)]
+        if content and config.get("preprocess"):
+            content, task_info["preprocessing"] = preprocess_content(
+                content, config["preprocess"]
+            )
         if content:
             prompt = content
         else:
             # Anthropic models require non-whitespace text in the message
             prompt = "extract"
 
-        kwargs["schema"] = {
-            "type": "object",
-            "description": "Extract data",
-            "properties": {
-                "items": {
-                    "type": "array",
-                    "items": {
-                        "type": "object",
-                        "properties": properties,
-                        "required": list(properties.keys()),
-                    },
-                }
-            },
-            "required": ["items"],
-        }
-
-        async for chunk in await model.prompt(prompt, **kwargs):
-            if chunk:
-                coro.send(chunk.encode("utf-8"))
-                if events:
-                    # Any we have not seen yet?
-                    unseen_events = [
-                        e for e in events if json.dumps(e) not in seen_events
-                    ]
-                    if unseen_events:
-                        for event in unseen_events:
-                            event = remove_null_bytes(event)
-                            seen_events.add(json.dumps(event))
-                            items.append(event)
-                            await db.execute_write_fn(make_row_writer(event))
+        kwargs["schema"] = extract_schema(properties)
+
+        async def handle_chunk(chunk):
+            if nested_writer:
+                await nested_writer.write(chunk.encode("utf-8"))
+                return
+            coro.send(chunk.encode("utf-8"))
+            # Take the newly parsed items so the parser does not accumulate them all
+            new_events = list(events)
+            del events[:]
+            for event in new_events:
+                # Skip items we have seen already, e.g. on a retry
+                event_hash = hash(json.dumps(event))
+                if event_hash in seen_hashes:
+                    continue
+                record_rowid(
+                    await db.execute_write_fn(make_row_writer(remove_null_bytes(event)))
+                )
+                # Only once written, so a failed write is never mistaken for a duplicate
+                seen_hashes.add(event_hash)
+                item_completed(event)
+
+        attempt = 0
+        while True:
+            attempt_prompt = prompt
+            if nested_writer:
+                # Items can legitimately share all of their fields apart from
+                # their children, so rather than deduplicating we drop the
+                # partly written item from a failed attempt, then run the
+                # original prompt again skipping the items already written
+                await nested_writer.discard()
+                nested_writer.start(skip=task_info["num_items"])
+            else:
+                # Fresh parser for each attempt, as a retried stream starts over
+                events = ijson.sendable_list()
+                coro = ijson.items_coro(events, "items.item", use_float=True)
+                num_items = task_info["num_items"]
+                if num_items:
+                    attempt_prompt = resume_prompt(
+                        prompt,
+                        num_items,
+                        await read_task_items(
+                            datasette,
+                            task_info,
+                            max(num_items - resume_items, 0),
+                            resume_items,
+                        ),
+                    )
+            spool = OutputSpool() if config.get("archive_output") else None
+            # A failure to parse or write the rows. These are not retried, as
+            # calling the model again would not fix them. When archiving they
+            # do not stop us from saving the rest of the model output.
+            failure = None
+            try:
+                try:
+                    async for chunk in await model.prompt(attempt_prompt, **kwargs):
+                        if not chunk:
+                            continue
+                        if spool:
+                            spool.write(chunk)
+                        if failure:
+                            continue
+                        try:
+                            await handle_chunk(chunk)
+                        except Exception as ex:
+                            failure = ex
+                            if not spool:
+                                break
+                finally:
+                    # Keep whatever output we received, even if the attempt failed
+                    if spool:
+                        await spool.save(db, task_id, attempt)
+            except Exception:
+                # Errors from the model stream, such as rate limits or a
+                # dropped connection, are retried
+                if failure is not None:
+                    raise failure
+                if attempt >= max_retries:
+                    raise
+                attempt += 1
+                task_info["retries"] = attempt
+                await asyncio.sleep(
+                    retry_delay(attempt, retry_backoff, retry_max_backoff)
+                )
+                continue
+            if failure is not None:
+                raise failure
+            if nested_writer:
+                # Output that stopped part way through an item
+                await nested_writer.discard()
+            break
+
+        if write_table != table:
+            merged = await db.execute_write_fn(
+                lambda conn: merge_staging_table(conn, write_table, table)
+            )
+            if merged:
+                # Merged in one transaction, so the new rowids are contiguous
+                task_info["first_rowid"], task_info["last_rowid"] = merged
+                rowid_ranges[:] = [list(merged)]
+            task_info["staging_table"] = None
 
     except Exception as ex:
         task_info["error"] = str(ex)
         error = str(ex)
     finally:
+        if write_table != table:
+            await db.execute_write_fn(
+                lambda conn: Database(conn)[write_table].drop(ignore=True)
+            )
         task_info["done"] = True
+        await record_run_end(
+            db,
+            task_id,
+            num_items=task_info["num_items"],
+            error=error,
+            retries=task_info["retries"],
+            preprocessing=(
+                json.dumps(task_info["preprocessing"])
+                if task_info["preprocessing"]
+                else None
+            ),
+        )
+
+
+class NestedItemParser:
+    """
+    Builds items from ijson.parse() events, yielding ("child", name, object) as
+    each object in one of the child arrays completes and ("item", None, item)
+    when the whole item completes.
+    """
+
+    def __init__(self, child_names):
+        import ijson
+
+        self.object_builder = ijson.ObjectBuilder
+        self.child_names = set(child_names)
+        self.item = None
+        self.key = None
+        self.builder = None
+        self.depth = 0
+        self.child_name = None
+
+    def fields(self, item=None):
+        # Fields of the current (or given) item, excluding child arrays
+        item = self.item if item is None else item
+        return {
+            key: value for key, value in item.items() if key not in self.child_names
+        }
+
+    def _build(self, event, value):
+        self.builder.event(event, value)
+        if event in ("start_map", "start_array"):
+            self.depth += 1
+        elif event in ("end_map", "end_array"):
+            self.depth -= 1
+        if self.depth == 0:
+            built, self.builder = self.builder.value, None
+            return built
+        return None
+
+    def feed(self, events):
+        for prefix, event, value in events:
+            if self.builder is not None:
+                built = self._build(event, value)
+                if self.builder is None:
+                    if self.child_name is not None:
+                        self.item[self.child_name].append(built)
+                        yield "child", self.child_name, built
+                    else:
+                        self.item[self.key] = built
+            elif self.child_name is not None:
+                # Inside a child array, between its objects
+                if event == "start_map":
+                    self.builder = self.object_builder()
+                    self._build(event, value)
+                elif event == "end_array":
+                    self.child_name = None
+            elif prefix == "items.item" and event == "start_map":
+                self.item = {}
+            elif prefix == "items.item" and event == "map_key":
+                self.key = value
+            elif prefix == "items.item" and event == "end_map":
+                item, self.item = self.item, None
+                yield "item", None, item
+            elif self.item is not None:
+                # The value for self.key
+                if event == "start_array" and self.key in self.child_names:
+                    self.child_name = self.key
+                    self.item[self.key] = []
+                elif event in ("start_map", "start_array"):
+                    self.builder = self.object_builder()
+                    self._build(event, value)
+                else:
+                    self.item[self.key] = value
+
+
+class NestedRowWriter:
+    """
+    Writes streamed items that have child arrays. Each parent row is inserted as
+    soon as it has a field and its first child completes - or once the whole
+    item completes - so that child rows can refer to its rowid in a {table}_id
+    column. Fields that arrive after the child arrays are filled in once the
+    item completes, then on_item(item, rowid) is called.
+    """
+
+    def __init__(self, db, table, children, on_item):
+        self.db = db
+        self.table = table
+        self.children = children
+        self.foreign_key = "{}_id".format(table)
+        self.on_item = on_item
+        self.num_child_items = {name: 0 for name in children}
+        self.rowid = None
+        self.row = None
+        self.child_rowids = []
+        # Children that completed before their parent had any fields
+        self.pending_children = []
+
+    def start(self, skip=0):
+        """
+        Start parsing a new stream, skipping its first skip items - the ones
+        already written from an earlier stream.
+        """
+        import ijson
+
+        self.events = ijson.sendable_list()
+        self.coro = ijson.parse_coro(self.events, use_float=True)
+        self.parser = NestedItemParser(self.children)
+        self.skip = skip
+        self.index = 0
+
+    async def write(self, data):
+        self.coro.send(data)
+        events = list(self.events)
+        del self.events[:]
+        for kind, name, value in self.parser.feed(events):
+            if self.index < self.skip:
+                if kind == "item":
+                    self.index += 1
+                continue
+            if kind == "child":
+                self.pending_children.append((name, value))
+                if self.row is None and self.parser.fields():
+                    await self._insert_parent(self.parser.fields())
+                if self.row is not None:
+                    await self._write_pending_children()
+                continue
+            fields = self.parser.fields(value)
+            if self.row is None:
+                await self._insert_parent(fields)
+            else:
+                updates = {key: fields[key] for key in fields if key not in self.row}
+                if updates:
+                    await self.db.execute_write_fn(
+                        self._update_parent(self.rowid, remove_null_bytes(updates))
+                    )
+            await self._write_pending_children()
+            rowid = self.rowid
+            self.index += 1
+            self.rowid, self.row, self.child_rowids = None, None, []
+            self.on_item(value, rowid)
+
+    async def _insert_parent(self, fields):
+        self.row = fields
+        self.rowid = await self.db.execute_write_fn(
+            self._parent_inserter(remove_null_bytes(fields))
+        )
+
+    async def _write_pending_children(self):
+        for name, value in self.pending_children:
+            row = dict(remove_null_bytes(value), **{self.foreign_key: self.rowid})
+            self.child_rowids.append(
+                (name, await self.db.execute_write_fn(self._child_inserter(name, row)))
+            )
+            self.num_child_items[name] += 1
+        self.pending_children = []
+
+    async def discard(self):
+        """
+        Delete the rows written so far for an item that never completed.
+        """
+        self.pending_children = []
+        if self.rowid is None:
+            return
+        rowid, child_rowids = self.rowid, self.child_rowids
+
+        def _delete(conn):
+            with conn:
+                for name, child_rowid in child_rowids:
+                    conn.execute(
+                        "delete from {} where rowid = ?".format(escape_sqlite(name)),
+                        [child_rowid],
+                    )
+                conn.execute(
+                    "delete from {} where rowid = ?".format(escape_sqlite(self.table)),
+                    [rowid],
+                )
 
-        def end_write(conn):
+        await self.db.execute_write_fn(_delete)
+        for name, _ in child_rowids:
+            self.num_child_items[name] -= 1
+        self.rowid, self.row, self.child_rowids = None, None, []
+
+    def _parent_inserter(self, row):
+        from sqlite_utils import Database
+
+        def _write(conn):
             with conn:
                 db = Database(conn)
-                db["_datasette_extract"].update(
-                    task_id,
-                    {
-                        "completed": datetime.now(timezone.utc).strftime(
-                            "%Y-%m-%d %H:%M:%S"
-                        ),
-                        "num_items": len(items),
-                        "error": error,
-                    },
+                if not row:
+                    # An item with nothing but child arrays
+                    if not db[self.table].exists():
+                        db[self.table].create({"id": int}, pk="id")
+                    return conn.execute(
+                        "insert into {} default values".format(
+                            escape_sqlite(self.table)
+                        )
+                    ).lastrowid
+                return db[self.table].insert(row, **new_table_pk(row)).last_rowid
+
+        return _write
+
+    def _update_parent(self, rowid, updates):
+        from sqlite_utils import Database
+
+        def _write(conn):
+            with conn:
+                Database(conn)[self.table].update(rowid, updates, alter=True)
+
+        return _write
+
+    def _child_inserter(self, name, row):
+        from sqlite_utils import Database
+
+        def _write(conn):
+            with conn:
+                db = Database(conn)
+                parent = db[self.table]
+                foreign_keys = None
+                # {table}_id holds the parent's rowid, so it can only be declared
+                # as a foreign key if the parent's id is an alias for its rowid
+                if (
+                    not db[name].exists()
+                    and parent.pks == ["id"]
+                    and parent.columns_dict["id"] is int
+                ):
+                    foreign_keys = [(self.foreign_key, self.table, "id")]
+                return (
+                    db[name]
+                    .insert(row, foreign_keys=foreign_keys, **new_table_pk(row))
+                    .last_rowid
                 )
 
-        await db.execute_write_fn(end_write)
+        return _write
 
 
-async def extract_to_table_post(
-    datasette,
-    request,
-    model_id,
-    instructions,
-    content,
-    image,
-    database,
-    table,
-    properties,
-):
-    # Here we go!
-    if not content and not image_is_provided(image) and not instructions:
-        return Response.text("No content provided", status=400)
+def new_table_pk(row):
+    # Give tables created for nested extraction an integer id primary key, for
+    # child rows to refer to - unless the model is extracting an id of its own
+    return {} if "id" in row else {"pk": "id"}
 
-    task_id = str(ulid.ULID())
 
-    asyncio.create_task(
-        extract_table_task(
-            datasette,
-            model_id,
-            database,
-            table,
-            properties,
-            instructions,
-            content,
-            image,
-            task_id,
-        )
-    )
-    return Response.redirect(
-        datasette.urls.path("/-/extract/progress/{}".format(task_id))
-    )
+class OutputSpool:
+    """
+    Compresses raw model output as it streams in, so it can be saved to
+    OUTPUT_TABLE and replayed later without calling the model again.
+    """
 
+    def __init__(self):
+        self.compressor = zlib.compressobj()
+        self.parts = []
+        self.size = 0
 
-def get_task_info(datasette, task_id):
-    extract_tasks = getattr(datasette, "_extract_tasks", None) or {}
-    return extract_tasks.get(task_id)
+    def write(self, chunk):
+        data = chunk.encode("utf-8")
+        self.size += len(data)
+        self.parts.append(self.compressor.compress(data))
 
+    async def save(self, db, run_id, attempt):
+        from sqlite_utils import Database
 
-async def extract_progress(datasette, request):
-    task_info = get_task_info(datasette, request.url_vars["task_id"])
-    if not task_info:
-        return Response.text("Task not found", status=404)
-    return Response.html(
-        await datasette.render_template(
-            "extract_progress.html",
-            {
-                "task": task_info,
-                "table_url": datasette.urls.table(
-                    task_info["database"], task_info["table"]
-                ),
-            },
-            request=request,
+        output = b"".join(self.parts) + self.compressor.flush()
+        await db.execute_write_fn(
+            lambda conn: Database(conn)[OUTPUT_TABLE].insert(
+                {
+                    "run_id": run_id,
+                    "attempt": attempt,
+                    "created": utc_now(),
+                    "size": self.size,
+                    "output": output,
+                },
+                pk=("run_id", "attempt"),
+                replace=True,
+            )
         )
-    )
-
 
-async def extract_progress_json(datasette, request):
-    task_info = get_task_info(datasette, request.url_vars["task_id"])
-    if not task_info:
-        return Response.json({"ok": False, "error": "Task not found"}, status=404)
-    return Response.json(task_info)
 
+def parse_output_items(output):
+    """
+    Parse the items out of raw model output. Output that was cut off part way
+    through still returns the items that were completed before that point.
+    """
+    import ijson
 
-@hookimpl
+    events = ijson.sendable_list()
+    coro = ijson.items_coro(events, "items.item", use_float=True)
+    try:
+        coro.send(output)
+        coro.close()
+    except ijson.JSONError:
+        pass
+    return list(events)
+
+
+async def replay_extract_output(datasette, database, run_id, table, task_id):
+    # Re-parse the archived output of a previous run into table, without
+    # calling the model
+    from sqlite_utils import Database
+
+    db = datasette.get_database(database)
+    run = (
+        await db.execute(
+            "select model, instructions, properties from _datasette_extract "
+            "where id = :id",
+            {"id": run_id},
+        )
+    ).first()
+    properties = json.loads(run["properties"])
+    instructions = run["instructions"] or ""
+    items = []
+    datasette._extract_tasks = getattr(datasette, "_extract_tasks", None) or {}
+    task_info = {
+        "items": items,
+        "database": database,
+        "model": run["model"],
+        "table": table,
+        "instructions": instructions,
+        "properties": properties,
+        "replay_of": run_id,
+        "num_items": 0,
+        "first_rowid": None,
+        "last_rowid": None,
+        "error": None,
+        "done": False,
+    }
+    datasette._extract_tasks[task_id] = task_info
+    await record_run_start(
+        db,
+        task_id,
+        database,
+        table,
+        run["model"],
+        instructions,
+        properties,
+        replay_of=run_id,
+    )
+    error = None
+    try:
+        outputs = await db.execute(
+            "select output from {} where run_id = :run_id order by attempt".format(
+                escape_sqlite(OUTPUT_TABLE)
+            ),
+            {"run_id": run_id},
+        )
+        children = child_tables(properties)
+        if children:
+            await replay_nested_output(db, table, children, outputs.rows, task_info)
+            return
+        # Later attempts can repeat items from earlier ones, same as a live run
+        seen_hashes = set()
+        rows = []
+        for output in outputs.rows:
+            for item in parse_output_items(zlib.decompress(output["output"])):
+                item_hash = hash(json.dumps(item))
+                if item_hash not in seen_hashes:
+                    seen_hashes.add(item_hash)
+                    rows.append(remove_null_bytes(item))
+        if rows:
+
+            def write_rows(conn):
+                with conn:
+                    Database(conn)[table].insert_all(rows)
+                    return conn.execute("select last_insert_rowid()").fetchone()[0]
+
+            last_rowid = await db.execute_write_fn(write_rows)
+            task_info["first_rowid"] = last_rowid - len(rows) + 1
+            task_info["last_rowid"] = last_rowid
+            task_info["num_items"] = len(rows)
+            items.extend(rows[-PREVIEW_ITEMS:])
+    except Exception as ex:
+        task_info["error"] = str(ex)
+        error = str(ex)
+    finally:
+        task_info["done"] = True
+        await record_run_end(db, task_id, num_items=task_info["num_items"], error=error)
+
+
+async def replay_nested_output(db, table, children, outputs, task_info):
+    # Write archived output with child arrays the same way a live run does:
+    # each retried attempt started over, so skip the items already written
+    import ijson
+
+    rowid_ranges = []
+
+    def item_written(item, rowid):
+        if task_info["first_rowid"] is None:
+            task_info["first_rowid"] = rowid
+        task_info["last_rowid"] = rowid
+        add_rowid(rowid_ranges, rowid)
+        task_info["num_items"] += 1
+        task_info["items"].append(remove_null_bytes(item))
+        del task_info["items"][:-PREVIEW_ITEMS]
+
+    writer = NestedRowWriter(db, table, children, item_written)
+    task_info["num_child_items"] = writer.num_child_items
+    task_info["rowid_ranges"] = rowid_ranges
+    for output in outputs:
+        writer.start(skip=task_info["num_items"])
+        try:
+            await writer.write(zlib.decompress(output["output"]))
+        except ijson.JSONError:
+            # Output that was cut off part way through
+            pass
+        await writer.discard()
+
+
+async def extract_replay(datasette, request):
+    import ulid
+
+    database = request.url_vars["database"]
+    run_id = request.url_vars["run_id"]
+    try:
+        db = datasette.get_database(database)
+    except KeyError:
+        raise NotFound("Database '{}' does not exist".format(database))
+    # Check the actor can extract at all before revealing which runs exist
+    if request.actor is None or not await datasette.allowed(
+        actor=request.actor, action="datasette-extract"
+    ):
+        raise Forbidden("Permission denied to extract data")
+    if request.method != "POST":
+        return Response.text("POST required", status=405)
+    if not await db.table_exists(OUTPUT_TABLE):
+        raise NotFound("No archived output for run '{}'".format(run_id))
+    run = (
+        await db.execute(
+            "select table_name, (select count(*) from {} where run_id = :id) as outputs "
+            "from _datasette_extract where id = :id".format(
+                escape_sqlite(OUTPUT_TABLE)
+            ),
+            {"id": run_id},
+        )
+    ).first()
+    if not run or not run["outputs"]:
+        raise NotFound("No archived output for run '{}'".format(run_id))
+
+    post_vars = await request.post_vars()
+    table = (post_vars.get("table") or "").strip() or run["table_name"]
+    table_exists = await db.table_exists(table)
+    if not await can_extract(
+        datasette, request.actor, database, table if table_exists else None
+    ):
+        raise Forbidden("Permission denied to extract data")
+
+    task_id = str(ulid.ULID())
+    asyncio.create_task(
+        replay_extract_output(datasette, database, run_id, table, task_id)
+    )
+    return Response.redirect(
+        datasette.urls.path("/-/extract/progress/{}".format(task_id))
+    )
+
+
+def staging_table_name(task_id):
+    return "_datasette_extract_staging_{}".format(task_id.lower())
+
+
+def merge_staging_table(conn, staging_table, table):
+    """
+    Copy every row from staging_table into table with a single INSERT ... SELECT,
+    creating table first if it does not exist yet. Returns the (first, last)
+    rowids of the copied rows.
+    """
+    from sqlite_utils import Database
+
+    db = Database(conn)
+    if not db[staging_table].exists():
+        # Nothing was extracted
+        return None
+    columns = db[staging_table].columns_dict
+    column_list = ", ".join(escape_sqlite(column) for column in columns)
+    with conn:
+        if not db[table].exists():
+            db[table].create(columns)
+        cursor = conn.execute(
+            "insert into {table} ({columns}) select {columns} from {staging} "
+            "order by rowid".format(
+                table=escape_sqlite(table),
+                columns=column_list,
+                staging=escape_sqlite(staging_table),
+            )
+        )
+        db[staging_table].drop()
+    if not cursor.rowcount:
+        return None
+    return cursor.lastrowid - cursor.rowcount + 1, cursor.lastrowid
+
+
+def add_rowid(rowid_ranges, rowid):
+    # Extend the last [first, last] run of rowids, or start a new one
+    if rowid_ranges and rowid_ranges[-1][1] == rowid - 1:
+        rowid_ranges[-1][1] = rowid
+    else:
+        rowid_ranges.append([rowid, rowid])
+
+
+async def read_task_items(datasette, task_info, offset, limit):
+    """
+    Read extracted items back from the table they were written to, using the
+    runs of rowids recorded for the task. There is a single run unless other
+    tasks wrote to the same table at the same time.
+    """
+    if task_info.get("first_rowid") is None or limit <= 0:
+        return []
+    rowid_ranges = task_info.get("rowid_ranges") or [
+        (task_info["first_rowid"], task_info["last_rowid"])
+    ]
+    db = datasette.get_database(task_info["database"])
+    sql = """
+        select {columns} from {table}
+        where rowid between ? and ?
+        order by rowid limit ? offset ?
+    """.format(
+        columns=", ".join(
+            escape_sqlite(c)
+            for c in task_info["properties"]
+            if c not in child_tables(task_info["properties"])
+        ),
+        table=escape_sqlite(task_info.get("staging_table") or task_info["table"]),
+    )
+
+    def read(conn):
+        rows = []
+        skip = offset
+        for first, last in rowid_ranges:
+            if len(rows) >= limit:
+                break
+            if skip > last - first:
+                skip -= last - first + 1
+                continue
+            cursor = conn.execute(sql, [first, last, limit - len(rows), skip])
+            columns = [d[0] for d in cursor.description]
+            rows.extend(dict(zip(columns, row)) for row in cursor.fetchall())
+            skip = 0
+        return rows
+
+    try:
+        return await db.execute_fn(read)
+    except Exception:
+        # Table may have been dropped or altered since
+        return []
+
+
+class BatchBackend:
+    """
+    Base class for batch backends, which submit many prompts at once to a
+    provider batch API and later return the raw output for each of them.
+    """
+
+    def __init__(self, datasette, config):
+        self.datasette = datasette
+        self.config = config
+
+    async def submit(self, requests):
+        """
+        Submit a list of request dicts with custom_id, model, prompt, system and
+        schema keys. Returns the batch ID.
+        """
+        raise NotImplementedError
+
+    async def results(self, batch_id):
+        """
+        Returns None while the batch is still pending, otherwise a dict mapping
+        each custom_id to a {"output": raw_text} or {"error": message} dict.
+        """
+        raise NotImplementedError
+
+
+class LocalFileBatchBackend(BatchBackend):
+    """
+    Stand-in backend that writes each batch to {directory}/{batch_id}.requests.jsonl
+    and considers it complete once {directory}/{batch_id}.results.jsonl exists.
+    """
+
+    @property
+    def directory(self):
+        return self.config.get("directory") or "extract-batches"
+
+    def _path(self, batch_id, suffix):
+        return os.path.join(self.directory, "{}.{}.jsonl".format(batch_id, suffix))
+
+    async def submit(self, requests):
+        import ulid
+
+        batch_id = "batch_{}".format(ulid.ULID())
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(batch_id, "requests"), "w") as fp:
+            for request in requests:
+                fp.write(json.dumps(request) + "\n")
+        return batch_id
+
+    async def results(self, batch_id):
+        path = self._path(batch_id, "results")
+        if not os.path.exists(path):
+            return None
+        results = {}
+        with open(path) as fp:
+            for line in fp:
+                if line.strip():
+                    result = json.loads(line)
+                    results[result.pop("custom_id")] = result
+        return results
+
+
+BATCH_BACKENDS = {
+    "local": LocalFileBatchBackend,
+}
+
+
+def get_batch_backend(datasette):
+    """
+    Returns the configured BatchBackend instance, or None if batch mode is not
+    configured. The backend is either a name from BATCH_BACKENDS or a
+    "module:ClassName" path to a BatchBackend subclass.
+    """
+    batch_config = get_config(datasette).get("batch")
+    if not batch_config:
+        return None
+    backend = batch_config.get("backend") or "local"
+    if backend in BATCH_BACKENDS:
+        cls = BATCH_BACKENDS[backend]
+    else:
+        cls = import_string(backend)
+    return cls(datasette, batch_config)
+
+
+async def submit_extract_batch(
+    datasette,
+    model_id,
+    database,
+    table,
+    properties,
+    instructions,
+    contents,
+    routing=None,
+    poll=True,
+):
+    """
+    Submit one prompt per item in contents as a single batch, then poll for
+    the results in the background - unless poll is False, in which case they
+    are picked up by resume_batch_tasks() the next time Datasette starts.
+    Returns the task ID.
+    """
+    import ulid
+
+    backend = get_batch_backend(datasette)
+    schema = extract_schema(properties)
+    steps = get_config(datasette).get("preprocess")
+    # Bytes and tokens saved by each pre-processing step, across all contents
+    preprocessing = {}
+    requests = []
+    for i, content in enumerate(contents):
+        if content and steps:
+            content, stats = preprocess_content(content, steps)
+            for stat in stats:
+                total = preprocessing.setdefault(
+                    stat["step"],
+                    {"step": stat["step"], "bytes_saved": 0, "tokens_saved": 0},
+                )
+                total["bytes_saved"] += stat["bytes_saved"]
+                total["tokens_saved"] += stat["tokens_saved"]
+        requests.append(
+            {
+                "custom_id": str(i),
+                "model": model_id,
+                # Anthropic models require non-whitespace text in the message
+                "prompt": content or "extract",
+                "system": instructions or None,
+                "schema": schema,
+            }
+        )
+    batch_id = await backend.submit(requests)
+    task_id = str(ulid.ULID())
+    db = datasette.get_database(database)
+    await record_run_start(
+        db,
+        task_id,
+        database,
+        table,
+        model_id,
+        instructions,
+        properties,
+        batch_id=batch_id,
+        routing=json.dumps(routing) if routing else None,
+        preprocessing=(
+            json.dumps(list(preprocessing.values())) if preprocessing else None
+        ),
+    )
+    if not poll:
+        return task_id
+    asyncio.create_task(
+        extract_batch_task(
+            datasette,
+            model_id,
+            database,
+            table,
+            properties,
+            instructions,
+            batch_id,
+            task_id,
+        )
+    )
+    return task_id
+
+
+async def extract_batch_task(
+    datasette,
+    model_id,
+    database,
+    table,
+    properties,
+    instructions,
+    batch_id,
+    task_id,
+):
+    from sqlite_utils import Database
+
+    # Polls a submitted batch and bulk inserts its rows once it completes
+    items = []
+    datasette._extract_tasks = getattr(datasette, "_extract_tasks", None) or {}
+    task_info = {
+        "items": items,
+        "database": database,
+        "model": model_id,
+        "table": table,
+        "instructions": instructions,
+        "properties": properties,
+        "batch_id": batch_id,
+        "num_items": 0,
+        "first_rowid": None,
+        "last_rowid": None,
+        "error": None,
+        "done": False,
+    }
+    datasette._extract_tasks[task_id] = task_info
+    db = datasette.get_database(database)
+    error = None
+    claimed = True
+    try:
+        backend = get_batch_backend(datasette)
+        poll_interval = backend.config.get("poll_interval", DEFAULT_BATCH_POLL_INTERVAL)
+        while True:
+            results = await backend.results(batch_id)
+            if results is not None:
+                break
+            await asyncio.sleep(poll_interval)
+
+        errors = []
+        rows = []
+        # Sort "2" before "10"
+        for custom_id, result in sorted(
+            results.items(), key=lambda pair: (len(pair[0]), pair[0])
+        ):
+            if result.get("error"):
+                errors.append("{}: {}".format(custom_id, result["error"]))
+                continue
+            try:
+                output = json.loads(result["output"])
+                rows.extend(remove_null_bytes(item) for item in output["items"])
+            except (ValueError, KeyError, TypeError) as ex:
+                errors.append("{}: {}".format(custom_id, ex))
+
+        def write_rows(conn):
+            with conn:
+                # Claim the run in the same transaction, so that when several
+                # processes are polling the same batch only one inserts its rows
+                cursor = conn.execute(
+                    "update _datasette_extract set completed = ? "
+                    "where id = ? and completed is null",
+                    [utc_now(), task_id],
+                )
+                if not cursor.rowcount:
+                    return None
+                if not rows:
+                    return 0
+                Database(conn)[table].insert_all(rows)
+                return conn.execute("select last_insert_rowid()").fetchone()[0]
+
+        last_rowid = await db.execute_write_fn(write_rows)
+        if last_rowid is None:
+            claimed = False
+            return
+        if rows:
+            task_info["first_rowid"] = last_rowid - len(rows) + 1
+            task_info["last_rowid"] = last_rowid
+            task_info["num_items"] = len(rows)
+            items.extend(rows[-PREVIEW_ITEMS:])
+        if errors:
+            error = "; ".join(errors)
+            task_info["error"] = error
+    except Exception as ex:
+        task_info["error"] = str(ex)
+        error = str(ex)
+    finally:
+        task_info["done"] = True
+        if claimed:
+            await record_run_end(
+                db, task_id, num_items=task_info["num_items"], error=error
+            )
+
+
+async def resume_batch_tasks(datasette):
+    # Resume polling any batches that were still pending when we last shut down
+    for database, db in datasette.databases.items():
+        if not await db.table_exists("_datasette_extract"):
+            continue
+        if "batch_id" not in await db.table_columns("_datasette_extract"):
+            continue
+        pending = await db.execute("""
+            select id, table_name, model, instructions, properties, batch_id
+            from _datasette_extract
+            where batch_id is not null and completed is null
+        """)
+        for row in pending.rows:
+            asyncio.create_task(
+                extract_batch_task(
+                    datasette,
+                    row["model"],
+                    database,
+                    row["table_name"],
+                    json.loads(row["properties"]),
+                    row["instructions"] or "",
+                    row["batch_id"],
+                    row["id"],
+                )
+            )
+
+
+@hookimpl
+def startup(datasette):
+    async def inner():
+        # The extract and extract-worker commands leave this to the web server
+        if getattr(datasette, "_extract_resume_batches", True) and (
+            get_batch_backend(datasette) is not None
+        ):
+            await resume_batch_tasks(datasette)
+
+    return inner
+
+
+async def extract_to_table_post(
+    datasette,
+    request,
+    model_id,
+    instructions,
+    content,
+    image,
+    database,
+    table,
+    properties,
+    mode=None,
+):
+    import ulid
+
+    # Here we go!
+    if not content and not image_is_provided(image) and not instructions:
+        return Response.text("No content provided", status=400)
+
+    routing = None
+    if model_id == AUTO_MODEL:
+        model_id, routing = await choose_model(
+            datasette, content, bool(image_is_provided(image)), properties
+        )
+        if model_id is None:
+            return Response.text("No suitable AI models available", status=400)
+
+    if mode == "batch":
+        if get_batch_backend(datasette) is None:
+            return Response.text("Batch mode is not configured", status=400)
+        if child_tables(properties):
+            return Response.text(
+                "Child tables are not supported in batch mode", status=400
+            )
+        if image_is_provided(image):
+            return Response.text("Images are not supported in batch mode", status=400)
+        task_id = await submit_extract_batch(
+            datasette,
+            model_id,
+            database,
+            table,
+            properties,
+            instructions,
+            [content],
+            routing=routing,
+        )
+        return Response.redirect(
+            datasette.urls.path("/-/extract/progress/{}".format(task_id))
+        )
+
+    task_id = str(ulid.ULID())
+
+    if get_config(datasette).get("queue"):
+        # Leave the extraction to a separate datasette extract-worker process
+        await enqueue_extract_job(
+            datasette,
+            model_id,
+            database,
+            table,
+            properties,
+            instructions,
+            content,
+            (await image.read()) if image_is_provided(image) else None,
+            task_id,
+            routing=routing,
+        )
+        return Response.redirect(
+            datasette.urls.path("/-/extract/progress/{}".format(task_id))
+        )
+
+    asyncio.create_task(
+        extract_table_task(
+            datasette,
+            model_id,
+            database,
+            table,
+            properties,
+            instructions,
+            content,
+            image,
+            task_id,
+            routing=routing,
+        )
+    )
+    return Response.redirect(
+        datasette.urls.path("/-/extract/progress/{}".format(task_id))
+    )
+
+
+async def ensure_jobs_table(db):
+    from sqlite_utils import Database
+
+    await db.execute_write_fn(
+        lambda conn: Database(conn)[JOBS_TABLE].create(
+            {
+                "id": str,
+                "database_name": str,
+                "table_name": str,
+                "created": str,
+                "model": str,
+                "instructions": str,
+                "properties": str,
+                "content": str,
+                "image": bytes,
+                "status": str,
+                "worker": str,
+                "claimed": str,
+                "heartbeat": str,
+                "completed": str,
+                "error": str,
+                "retries": int,
+                "num_items": int,
+                "recent_items": str,
+                "routing": str,
+            },
+            pk="id",
+            if_not_exists=True,
+        )
+    )
+
+
+async def enqueue_extract_job(
+    datasette,
+    model_id,
+    database,
+    table,
+    properties,
+    instructions,
+    content,
+    image_bytes,
+    task_id,
+    routing=None,
+):
+    """
+    Queue an extraction to be run by a datasette extract-worker process.
+    """
+    from sqlite_utils import Database
+
+    db = datasette.get_database(database)
+    await ensure_jobs_table(db)
+    await db.execute_write_fn(
+        lambda conn: Database(conn)[JOBS_TABLE].insert(
+            {
+                "id": task_id,
+                "database_name": database,
+                "table_name": table,
+                "created": utc_now(),
+                "model": model_id,
+                "instructions": instructions,
+                "properties": json.dumps(properties),
+                "content": content,
+                "image": image_bytes,
+                "status": "queued",
+                "retries": 0,
+                "num_items": 0,
+                "routing": json.dumps(routing) if routing else None,
+            },
+            alter=True,
+        )
+    )
+
+
+def claim_job(conn, worker_id, lease=DEFAULT_JOB_LEASE):
+    """
+    Claim the oldest queued job, or a running job whose worker has not sent a
+    heartbeat for lease seconds - it most likely died part way through.
+    """
+    # begin immediate so that two workers can never claim the same job
+    conn.execute("begin immediate")
+    job = None
+    try:
+        cursor = conn.execute(
+            """
+            select * from {} where status = 'queued'
+            or (status = 'running' and coalesce(heartbeat, claimed) < ?)
+            order by id limit 1
+            """.format(escape_sqlite(JOBS_TABLE)),
+            [utc_now(lease)],
+        )
+        row = cursor.fetchone()
+        if row is not None:
+            job = dict(zip([d[0] for d in cursor.description], row))
+            now = utc_now()
+            conn.execute(
+                "update {} set status = 'running', worker = ?, claimed = ?, "
+                "heartbeat = ? where id = ?".format(escape_sqlite(JOBS_TABLE)),
+                [worker_id, now, now, job["id"]],
+            )
+        conn.execute("commit")
+    except Exception:
+        conn.execute("rollback")
+        raise
+    return job
+
+
+class QueuedImage:
+    """
+    Stands in for an uploaded image file when a worker runs a queued job.
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self.size = len(content)
+
+    async def read(self):
+        return self.content
+
+
+async def run_extract_job(datasette, job, progress_interval=1.0):
+    from sqlite_utils import Database
+
+    db = datasette.get_database(job["database_name"])
+    task_id = job["id"]
+
+    async def write_progress():
+        extract_tasks = getattr(datasette, "_extract_tasks", None) or {}
+        task_info = extract_tasks.get(task_id) or {}
+        updates = {
+            "num_items": task_info.get("num_items") or 0,
+            "recent_items": json.dumps(
+                (task_info.get("items") or [])[-PROGRESS_ITEMS:]
+            ),
+            "retries": task_info.get("retries") or 0,
+            # Renews the lease on the job, see claim_job()
+            "heartbeat": utc_now(),
+        }
+        if task_info.get("done"):
+            updates["status"] = "error" if task_info["error"] else "done"
+            updates["error"] = task_info["error"]
+            updates["completed"] = utc_now()
+        await db.execute_write_fn(
+            lambda conn: Database(conn)[JOBS_TABLE].update(task_id, updates)
+        )
+
+    properties = json.loads(job["properties"])
+    if job.get("claimed") and child_tables(properties):
+        # Reclaimed from a worker that died part way through. Nested extractions
+        # cannot be staged, so running again could duplicate the rows it wrote
+        error = "Worker stopped part way through, child table jobs cannot be re-run"
+
+        def fail_job(conn):
+            with conn:
+                conn.execute(
+                    "update {} set status = 'error', error = ?, completed = ? "
+                    "where id = ?".format(escape_sqlite(JOBS_TABLE)),
+                    [error, utc_now(), task_id],
+                )
+                if Database(conn)["_datasette_extract"].exists():
+                    conn.execute(
+                        "update _datasette_extract set error = ?, completed = ? "
+                        "where id = ?",
+                        [error, utc_now(), task_id],
+                    )
+
+        await db.execute_write_fn(fail_job)
+        return
+    task = asyncio.create_task(
+        extract_table_task(
+            datasette,
+            job["model"],
+            job["database_name"],
+            job["table_name"],
+            properties,
+            job["instructions"] or "",
+            job["content"] or "",
+            QueuedImage(job["image"]) if job["image"] else "",
+            task_id,
+            routing=json.loads(job["routing"]) if job.get("routing") else None,
+            # So a worker that dies part way through leaves no rows behind in
+            # the table for the worker that reclaims the job to duplicate
+            staging=True,
+        )
+    )
+    while not task.done():
+        await asyncio.wait([task], timeout=progress_interval)
+        await write_progress()
+    try:
+        await task
+    except Exception as ex:
+        # Failed before it could record its own error
+        updates = {"status": "error", "error": str(ex), "completed": utc_now()}
+        await db.execute_write_fn(
+            lambda conn: Database(conn)[JOBS_TABLE].update(task_id, updates)
+        )
+    # Free the in-memory copy, progress now lives in the jobs table
+    getattr(datasette, "_extract_tasks", {}).pop(task_id, None)
+
+
+async def run_extract_worker(
+    datasette, worker_id=None, poll_interval=DEFAULT_WORKER_POLL_INTERVAL, once=False
+):
+    """
+    Claim and run queued jobs from every attached database. If once is True
+    returns as soon as there are no more queued jobs.
+    """
+    import ulid
+
+    worker_id = worker_id or "worker-{}".format(ulid.ULID())
+    lease = get_config(datasette).get("job_lease", DEFAULT_JOB_LEASE)
+    while True:
+        job = None
+        for db in datasette.databases.values():
+            if not db.is_mutable or not await db.table_exists(JOBS_TABLE):
+                continue
+            job = await db.execute_write_fn(
+                lambda conn: claim_job(conn, worker_id, lease), transaction=False
+            )
+            if job:
+                break
+        if job:
+            await run_extract_job(datasette, job)
+        elif once:
+            return
+        else:
+            await asyncio.sleep(poll_interval)
+
+
+async def get_task_info(datasette, task_id):
+    extract_tasks = getattr(datasette, "_extract_tasks", None) or {}
+    task_info = extract_tasks.get(task_id)
+    if task_info or not get_config(datasette).get("queue"):
+        return task_info
+    # Might be a job that is being handled by a worker process
+    for db in datasette.databases.values():
+        if not await db.table_exists(JOBS_TABLE):
+            continue
+        job = (
+            await db.execute(
+                """
+            select database_name, model, table_name, instructions, properties,
+            status, error, retries, num_items, recent_items
+            from {} where id = ?
+        """.format(escape_sqlite(JOBS_TABLE)),
+                [task_id],
+            )
+        ).first()
+        if job:
+            return {
+                "items": json.loads(job["recent_items"] or "[]"),
+                "database": job["database_name"],
+                "model": job["model"],
+                "table": job["table_name"],
+                "instructions": job["instructions"],
+                "properties": json.loads(job["properties"]),
+                "error": job["error"],
+                "retries": job["retries"],
+                "status": job["status"],
+                "num_items": job["num_items"],
+                "done": job["status"] in ("done", "error"),
+            }
+    return None
+
+
+async def extract_progress(datasette, request):
+    task_info = await get_task_info(datasette, request.url_vars["task_id"])
+    if not task_info:
+        return Response.text("Task not found", status=404)
+    return Response.html(
+        await datasette.render_template(
+            "extract_progress.html",
+            {
+                "task": task_info,
+                "table_url": datasette.urls.table(
+                    task_info["database"], task_info["table"]
+                ),
+                "columns": list(task_info["properties"].keys()),
+                "max_rows": PROGRESS_MAX_ROWS,
+            },
+            request=request,
+        )
+    )
+
+
+async def extract_progress_json(datasette, request):
+    task_info = await get_task_info(datasette, request.url_vars["task_id"])
+    if not task_info:
+        return Response.json({"ok": False, "error": "Task not found"}, status=404)
+    if request.args.get("_since"):
+        # Only return items after the first ?_since= items, for incremental polling
+        try:
+            since = int(request.args["_since"])
+        except ValueError:
+            return Response.json(
+                {"ok": False, "error": "_since must be an integer"}, status=400
+            )
+        items = list(task_info["items"])
+        # items only holds the most recent items, older ones are read from the table
+        offset = task_info["num_items"] - len(items)
+        if since < offset:
+            older = await read_task_items(
+                datasette, task_info, since, min(offset - since, PROGRESS_MAX_ROWS)
+            )
+            if since + len(older) == offset:
+                older.extend(items)
+                items = older
+            elif older:
+                items = older
+            else:
+                # Older items cannot be read back, e.g. for a job run by a
+                # worker process, so skip ahead to the most recent items
+                since = offset
+        else:
+            items = items[since - offset :]
+        task_info = dict(task_info, items=items, items_offset=since)
+    # The runs of rowids are only needed to read items back
+    return Response.json(
+        {key: value for key, value in task_info.items() if key != "rowid_ranges"}
+    )
+
+
+@hookimpl
 def register_routes():
     return [
         (r"^/(?P<database>[^/]+)/-/extract$", extract_create_table),
         (r"^/(?P<database>[^/]+)/(?P<table>[^/]+)/-/extract$", extract_to_table),
+        (
+            r"^/(?P<database>[^/]+)/-/extract/replay/(?P<run_id>\w+)$",
+            extract_replay,
+        ),
         (r"^/-/extract/progress/(?P<task_id>\w+)$", extract_progress),
         (r"^/-/extract/progress/(?P<task_id>\w+)\.json$", extract_progress_json),
     ]
 
 
+def retry_delay(attempt, backoff, max_backoff):
+    """
+    Exponential backoff with full jitter for the given retry attempt (1-based).
+    """
+    delay = min(max_backoff, backoff * (2 ** (attempt - 1)))
+    return random.uniform(0, delay)
+
+
+def resume_prompt(prompt, num_items, items):
+    """
+    Prompt for a retried attempt, telling the model how many items it already
+    produced and what the most recent of them were, so that it only returns the
+    remaining ones without the prompt growing with every item.
+    """
+    return (
+        "{}\n\n"
+        "{} already been extracted, ending with these. Do not include them "
+        "again, only return the items that come after them:\n\n{}".format(
+            prompt,
+            "1 item has" if num_items == 1 else "{} items have".format(num_items),
+            json.dumps(items),
+        )
+    )
+
+
+@hookimpl
+def register_commands(cli):
+    @cli.command(name="extract-worker")
+    @click.argument(
+        "files", type=click.Path(exists=True, dir_okay=False), nargs=-1, required=True
+    )
+    @click.option(
+        "-c",
+        "--config",
+        type=click.File("r"),
+        help="Datasette configuration file, for plugin and model settings",
+    )
+    @click.option(
+        "--poll-interval",
+        type=float,
+        default=DEFAULT_WORKER_POLL_INTERVAL,
+        show_default=True,
+        help="Seconds to wait between checks for new jobs",
+    )
+    @click.option(
+        "--concurrency",
+        type=click.IntRange(min=1),
+        default=1,
+        show_default=True,
+        help="Number of jobs to run at once",
+    )
+    @click.option(
+        "--once", is_flag=True, help="Exit once there are no more queued jobs"
+    )
+    def extract_worker(files, config, poll_interval, concurrency, once):
+        "Run queued datasette-extract jobs against these databases"
+        from datasette.app import Datasette
+        from datasette.utils import parse_metadata
+        import ulid
+
+        ds = Datasette(files, config=parse_metadata(config.read()) if config else None)
+
+        # Pending batches are polled by the web server, see resume_batch_tasks()
+        ds._extract_resume_batches = False
+
+        async def run():
+            await ds.invoke_startup()
+            await asyncio.gather(
+                *[
+                    run_extract_worker(
+                        ds,
+                        worker_id="worker-{}-{}".format(ulid.ULID(), i),
+                        poll_interval=poll_interval,
+                        once=once,
+                    )
+                    for i in range(concurrency)
+                ]
+            )
+
+        asyncio.run(run())
+
+    @cli.command(name="extract")
+    @click.argument("database", type=click.Path(exists=True, dir_okay=False))
+    @click.argument("table")
+    @click.argument("paths", type=click.Path(exists=True), nargs=-1, required=True)
+    @click.option(
+        "-p",
+        "--property",
+        "property_specs",
+        multiple=True,
+        help="Column to extract as name, name:type or name:type:hint - "
+        "defaults to the columns of the existing table",
+    )
+    @click.option("-m", "--model", "model_id", help="Model to use")
+    @click.option("-i", "--instructions", default="", help="Additional instructions")
+    @click.option(
+        "-c",
+        "--config",
+        type=click.File("r"),
+        help="Datasette configuration file, for plugin and model settings",
+    )
+    @click.option(
+        "--parallel",
+        type=click.IntRange(min=1),
+        default=4,
+        show_default=True,
+        help="Number of files to process at once",
+    )
+    @click.option(
+        "--batch",
+        is_flag=True,
+        help="Submit all of the files as a single offline batch job",
+    )
+    def extract(
+        database,
+        table,
+        paths,
+        property_specs,
+        model_id,
+        instructions,
+        config,
+        parallel,
+        batch,
+    ):
+        "Extract data from files and directories of files into a table"
+        from datasette.app import Datasette
+        from datasette.utils import parse_metadata
+        from sqlite_utils import Database
+
+        ds = Datasette(
+            [database], config=parse_metadata(config.read()) if config else None
+        )
+        database_name = next(iter(ds.databases))
+
+        def report(path, task_info, elapsed):
+            click.echo(
+                "{}: {} item{} in {:.1f}s{}".format(
+                    path,
+                    task_info["num_items"],
+                    "" if task_info["num_items"] == 1 else "s",
+                    elapsed,
+                    (
+                        " - error: {}".format(task_info["error"])
+                        if task_info["error"]
+                        else ""
+                    ),
+                ),
+                err=True,
+            )
+
+        # Pending batches are polled by the web server, see resume_batch_tasks()
+        ds._extract_resume_batches = False
+
+        def skipped(path):
+            click.echo("{}: skipped, not a text or image file".format(path), err=True)
+
+        async def run():
+            await ds.invoke_startup()
+            db = ds.get_database(database_name)
+            if property_specs:
+                properties = parse_property_specs(property_specs)
+            elif await db.table_exists(table):
+                columns = await db.execute_fn(
+                    lambda conn: Database(conn)[table].columns_dict
+                )
+                properties = {
+                    name: {"type": get_type(type_)} for name, type_ in columns.items()
+                }
+            else:
+                raise click.ClickException(
+                    "Table {} does not exist, use --property to define columns".format(
+                        table
+                    )
+                )
+            available_ids = [m.model_id for m in await _get_available_models(ds)]
+            if not available_ids:
+                raise click.ClickException("No suitable models are available")
+            if model_id and model_id not in available_ids:
+                raise click.ClickException(
+                    "Model {} is not available, choose from: {}".format(
+                        model_id, ", ".join(available_ids)
+                    )
+                )
+            run_model_id = model_id or (
+                AUTO_MODEL if get_config(ds).get("routing") else available_ids[0]
+            )
+            file_paths = list(iter_files(paths))
+            if batch:
+                await submit_files_batch(
+                    run_model_id, properties, file_paths, available_ids
+                )
+                return None
+            return await extract_files(
+                ds,
+                run_model_id,
+                database_name,
+                table,
+                properties,
+                instructions,
+                file_paths,
+                parallel=parallel,
+                report=report,
+                skipped=skipped,
+            )
+
+        async def submit_files_batch(
+            run_model_id, properties, file_paths, available_ids
+        ):
+            if get_batch_backend(ds) is None:
+                raise click.ClickException("Batch mode is not configured")
+            images = [p for p in file_paths if p.lower().endswith(IMAGE_EXTENSIONS)]
+            if images:
+                raise click.ClickException(
+                    "Images are not supported in batch mode: {}".format(
+                        ", ".join(images)
+                    )
+                )
+            contents = []
+            for path in file_paths:
+                content = read_text_file(path)
+                if content is None:
+                    skipped(path)
+                else:
+                    contents.append(content)
+            if not contents:
+                raise click.ClickException("No text files to submit")
+            routing = None
+            if run_model_id == AUTO_MODEL:
+                # One model for the whole batch, picked for the longest file
+                run_model_id, routing = route_model(
+                    get_config(ds).get("routing") or [],
+                    available_ids,
+                    max(len(content) for content in contents),
+                    False,
+                    len(properties),
+                )
+            # The batch is polled by Datasette itself, see resume_batch_tasks()
+            task_id = await submit_extract_batch(
+                ds,
+                run_model_id,
+                database_name,
+                table,
+                properties,
+                instructions,
+                contents,
+                routing=routing,
+                poll=False,
+            )
+            click.echo(
+                "Submitted {} file{} as batch task {}, rows will be inserted by "
+                "Datasette once the batch completes".format(
+                    len(contents), "" if len(contents) == 1 else "s", task_id
+                ),
+                err=True,
+            )
+
+        start = time.monotonic()
+        results = asyncio.run(run())
+        if results is None:
+            # Submitted as a batch
+            return
+        elapsed = time.monotonic() - start
+        num_items = sum(task_info["num_items"] for task_info in results)
+        click.echo(
+            "Extracted {} item{} from {} file{} in {:.1f}s ({:.2f} items/s)".format(
+                num_items,
+                "" if num_items == 1 else "s",
+                len(results),
+                "" if len(results) == 1 else "s",
+                elapsed,
+                num_items / elapsed if elapsed else 0,
+            ),
+            err=True,
+        )
+        if any(task_info["error"] for task_info in results):
+            raise click.ClickException("Some files failed to extract")
+
+
+def parse_property_specs(specs):
+    properties = {}
+    for spec in specs:
+        name, _, rest = spec.partition(":")
+        type_, _, hint = rest.partition(":")
+        if type_ and type_ not in ("string", "integer", "number"):
+            raise click.BadParameter(
+                "type must be string, integer or number, got {}".format(type_),
+                param_hint="--property",
+            )
+        properties[name] = {"type": type_ or "string"}
+        if hint:
+            properties[name]["description"] = hint
+    return properties
+
+
+def read_text_file(path):
+    """
+    Returns the contents of a UTF-8 text file, or None for binary files such as
+    PDFs that would only send garbage to the model.
+    """
+    with open(path, "rb") as fp:
+        data = fp.read()
+    if b"\x00" in data:
+        return None
+    try:
+        return data.decode("utf-8").strip()
+    except UnicodeDecodeError:
+        return None
+
+
+def iter_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for filename in sorted(files):
+                    if not filename.startswith("."):
+                        yield os.path.join(root, filename)
+        else:
+            yield path
+
+
+async def extract_files(
+    datasette,
+    model_id,
+    database,
+    table,
+    properties,
+    instructions,
+    paths,
+    parallel=4,
+    report=None,
+    skipped=None,
+):
+    """
+    Run extract_table_task against each file in paths, at most parallel at a
+    time. Image files are sent as attachments, UTF-8 text files as text and any
+    other files are skipped, calling skipped(path). A model_id of AUTO_MODEL
+    picks a model for each file using the routing rules. Returns the task_info
+    dictionary for each file that was extracted, calling report(path,
+    task_info, elapsed) as each one finishes.
+    """
+    import ulid
+
+    semaphore = asyncio.Semaphore(parallel)
+
+    async def extract_file(path):
+        async with semaphore:
+            if path.lower().endswith(IMAGE_EXTENSIONS):
+                with open(path, "rb") as fp:
+                    content, image = "", QueuedImage(fp.read())
+            else:
+                content, image = read_text_file(path), ""
+                if content is None:
+                    if skipped:
+                        skipped(path)
+                    return None
+            file_model_id, routing = model_id, None
+            if model_id == AUTO_MODEL:
+                file_model_id, routing = await choose_model(
+                    datasette, content, bool(image), properties
+                )
+            task_id = str(ulid.ULID())
+            start = time.monotonic()
+            await extract_table_task(
+                datasette,
+                file_model_id,
+                database,
+                table,
+                properties,
+                instructions,
+                content,
+                image,
+                task_id,
+                routing=routing,
+            )
+            task_info = datasette._extract_tasks.pop(task_id)
+            if report:
+                report(path, task_info, time.monotonic() - start)
+            return task_info
+
+    results = await asyncio.gather(*[extract_file(path) for path in paths])
+    return [task_info for task_info in results if task_info is not None]
+
+
+def route_model(rules, available_ids, length, has_image, num_properties):
+    """
+    Pick a model using the first routing rule that matches the input and names
+    an available model, falling back to the first available model. Returns the
+    model ID and a dictionary describing the decision.
+    """
+    decision = {
+        "length": length,
+        "image": has_image,
+        "properties": num_properties,
+        "rule": None,
+    }
+    for index, rule in enumerate(rules):
+        if rule.get("model") not in available_ids:
+            continue
+        if "max_length" in rule and length > rule["max_length"]:
+            continue
+        if "min_length" in rule and length < rule["min_length"]:
+            continue
+        if "image" in rule and bool(rule["image"]) != has_image:
+            continue
+        if "max_properties" in rule and num_properties > rule["max_properties"]:
+            continue
+        if "min_properties" in rule and num_properties < rule["min_properties"]:
+            continue
+        decision["rule"] = index
+        return rule["model"], decision
+    if not available_ids:
+        return None, decision
+    return available_ids[0], decision
+
+
+async def choose_model(datasette, content, has_image, properties):
+    available_ids = [m.model_id for m in await _get_available_models(datasette)]
+    return route_model(
+        get_config(datasette).get("routing") or [],
+        available_ids,
+        len(content or ""),
+        has_image,
+        len(properties),
+    )
+
+
 def get_type(type_):
     if type_ is int:
         return "integer"
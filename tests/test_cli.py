@@ -0,0 +1,151 @@
+from click.testing import CliRunner
+from datasette.cli import cli
+import json
+import pytest
+import sqlite_utils
+from unittest.mock import AsyncMock, patch
+
+
+def mock_model():
+    async def fake_prompt(prompt_text, **kwargs):
+        # Echo each line of the input back as an extracted name
+        names = [line for line in prompt_text.splitlines() if line.strip()]
+        if kwargs.get("attachments"):
+            names = ["From image"]
+        body = '{"items": [%s]}' % ", ".join('{"name": "%s"}' % n for n in names)
+
+        async def aiter_chunks():
+            yield body
+
+        mock_response = AsyncMock()
+        mock_response.__aiter__ = lambda self: aiter_chunks()
+        return mock_response
+
+    wrapped = AsyncMock()
+    wrapped.prompt = fake_prompt
+    return wrapped
+
+
+@pytest.fixture
+def files(tmp_path):
+    docs = tmp_path / "docs"
+    (docs / "nested").mkdir(parents=True)
+    (docs / "one.txt").write_text("Sergei\nCynthia\n")
+    (docs / "nested" / "two.txt").write_text("Bob\n")
+    (docs / "photo.jpg").write_bytes(b"\xff\xd8\xff\xe0" + b"\x00" * 100)
+    (docs / ".hidden").write_text("Ignored\n")
+    (docs / "report.pdf").write_bytes(b"%PDF-1.4\n\x00\xff\xfe binary")
+    path = str(tmp_path / "data.db")
+    sqlite_utils.Database(path).vacuum()
+    return path, docs
+
+
+def test_extract_command(files):
+    path, docs = files
+    with patch("datasette_llm.LLM.model") as model:
+        model.return_value = mock_model()
+        result = CliRunner().invoke(
+            cli,
+            [
+                "extract",
+                path,
+                "people",
+                str(docs),
+                "-p",
+                "name:string:First name",
+                "-m",
+                "gpt-4.1-mini",
+                "--parallel",
+                "2",
+            ],
+        )
+    assert result.exit_code == 0, result.output
+    assert "Extracted 4 items from 3 files" in result.output
+    assert "report.pdf: skipped, not a text or image file" in result.output
+    db = sqlite_utils.Database(path)
+    assert sorted(row["name"] for row in db["people"].rows) == [
+        "Bob",
+        "Cynthia",
+        "From image",
+        "Sergei",
+    ]
+    runs = list(db["_datasette_extract"].rows)
+    assert len(runs) == 3
+    assert {run["model"] for run in runs} == {"gpt-4.1-mini"}
+    assert sorted(run["num_items"] for run in runs) == [1, 1, 2]
+
+
+def test_extract_command_uses_existing_columns(files):
+    path, docs = files
+    sqlite_utils.Database(path)["people"].create({"name": str})
+    with patch("datasette_llm.LLM.model") as model:
+        model.return_value = mock_model()
+        result = CliRunner().invoke(
+            cli, ["extract", path, "people", str(docs / "one.txt")]
+        )
+    assert result.exit_code == 0, result.output
+    db = sqlite_utils.Database(path)
+    assert [row["name"] for row in db["people"].rows] == ["Sergei", "Cynthia"]
+
+
+def test_extract_command_errors(files):
+    path, docs = files
+    result = CliRunner().invoke(cli, ["extract", path, "missing", str(docs)])
+    assert result.exit_code == 1
+    assert "Table missing does not exist" in result.output
+    result = CliRunner().invoke(
+        cli, ["extract", path, "people", str(docs), "-p", "name", "-m", "nope"]
+    )
+    assert result.exit_code == 1
+    assert "Model nope is not available" in result.output
+    result = CliRunner().invoke(
+        cli, ["extract", path, "people", str(docs), "-p", "name", "--parallel", "0"]
+    )
+    assert result.exit_code == 2
+    assert "--parallel" in result.output
+    result = CliRunner().invoke(cli, ["extract-worker", path, "--concurrency", "0"])
+    assert result.exit_code == 2
+    assert "--concurrency" in result.output
+
+
+def test_extract_command_batch(files, tmp_path):
+    path, docs = files
+    batch_dir = tmp_path / "batches"
+    config = tmp_path / "config.json"
+    config.write_text(
+        json.dumps(
+            {
+                "plugins": {
+                    "datasette-extract": {
+                        "batch": {"backend": "local", "directory": str(batch_dir)},
+                        "preprocess": ["whitespace"],
+                    }
+                }
+            }
+        )
+    )
+    args = ["extract", path, "people", "-p", "name", "-c", str(config), "--batch"]
+    # Images cannot be sent in a batch
+    result = CliRunner().invoke(cli, args[:3] + [str(docs)] + args[3:])
+    assert result.exit_code == 1
+    assert "Images are not supported in batch mode" in result.output
+
+    (docs / "one.txt").write_text("Sergei   \n\n\n\nCynthia\n")
+    with patch("datasette_llm.LLM.model") as model:
+        result = CliRunner().invoke(
+            cli,
+            args[:3]
+            + [str(docs / "one.txt"), str(docs / "nested" / "two.txt")]
+            + args[3:],
+        )
+        # Nothing is sent to the model until the batch is processed
+        assert not model.called
+    assert result.exit_code == 0, result.output
+    assert "Submitted 2 files as batch task" in result.output
+    db = sqlite_utils.Database(path)
+    run = list(db["_datasette_extract"].rows)[0]
+    assert run["completed"] is None
+    assert json.loads(run["preprocessing"])[0]["step"] == "whitespace"
+    requests_file = batch_dir / "{}.requests.jsonl".format(run["batch_id"])
+    prompts = [json.loads(line)["prompt"] for line in requests_file.open()]
+    assert prompts == ["Sergei\n\nCynthia", "Bob"]
@@ -0,0 +1,38 @@
+import json
+import os
+import subprocess
+import sys
+
+# Datasette imports every plugin at startup, so importing this one should be cheap
+IMPORT_BUDGET_SECONDS = 0.1
+
+MEASURE = """
+import json, sys, time
+import datasette.app
+before = set(sys.modules)
+start = time.perf_counter()
+import datasette_extract
+print(json.dumps({
+    "elapsed": time.perf_counter() - start,
+    "modules": sorted(set(sys.modules) - before),
+}))
+"""
+
+
+def measure_import():
+    # Stop Datasette from loading this plugin itself on import of datasette.app
+    env = dict(os.environ, DATASETTE_LOAD_PLUGINS="")
+    output = subprocess.check_output([sys.executable, "-c", MEASURE], env=env)
+    return json.loads(output)
+
+
+def test_import_does_not_load_heavy_modules():
+    modules = measure_import()["modules"]
+    for heavy in ("ijson", "llm", "openai", "ulid"):
+        assert heavy not in modules
+
+
+def test_import_time_budget():
+    # Best of three runs, to smooth out noise from the test machine
+    elapsed = min(measure_import()["elapsed"] for _ in range(3))
+    assert elapsed < IMPORT_BUDGET_SECONDS
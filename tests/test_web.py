@@ -1,8 +1,18 @@
 import asyncio
 from datasette.app import Datasette
-from datasette_extract import remove_null_bytes
+from datasette_extract import (
+    extract_table_task,
+    preprocess_content,
+    read_task_items,
+    remove_null_bytes,
+    replay_extract_output,
+    route_model,
+    submit_extract_batch,
+)
 import json
 import pytest
+import sqlite_utils
+from sqlite_utils import Database
 from unittest.mock import AsyncMock, patch
 import urllib
 from io import BytesIO
@@ -60,7 +70,13 @@ async def test_extract_flow():
         "table": "ages",
         "instructions": "Be nice",
         "properties": {"name": {"type": "string"}, "age": {"type": "integer"}},
+        "num_items": 2,
+        "first_rowid": 1,
+        "last_rowid": 2,
         "error": None,
+        "retries": 0,
+        "preprocessing": [],
+        "routing": None,
         "done": True,
     }
 
@@ -303,3 +319,1017 @@ async def test_image_upload():
     # Should have received an attachment
     assert len(captured_kwargs) == 1
     assert "attachments" in captured_kwargs[0]
+
+
+def fake_stream(*chunks, error=None):
+    async def aiter_chunks():
+        for chunk in chunks:
+            yield chunk
+        if error:
+            raise error
+
+    mock_response = AsyncMock()
+    mock_response.__aiter__ = lambda self: aiter_chunks()
+    return mock_response
+
+
+@pytest.mark.asyncio
+async def test_retry_resumes_without_duplicates():
+    ds = Datasette(
+        config={
+            "plugins": {"datasette-extract": {"retry_backoff": 0, "resume_items": 1}}
+        }
+    )
+    db = ds.add_memory_database("retry_resume")
+    captured_prompts = []
+    responses = [
+        fake_stream(
+            '{"items": [{"name": "Sergei"}, ',
+            '{"name": "Cynthia"}, {"na',
+            error=ConnectionError("Connection dropped"),
+        ),
+        fake_stream('{"items": [{"name": "Cynthia"}, {"name": "Bob"}]}'),
+    ]
+
+    async def fake_prompt(prompt_text, **kwargs):
+        captured_prompts.append(prompt_text)
+        return responses.pop(0)
+
+    with patch("datasette_llm.LLM.model") as mock_model:
+        wrapped = AsyncMock()
+        wrapped.prompt = fake_prompt
+        mock_model.return_value = wrapped
+        await extract_table_task(
+            ds,
+            "gpt-4.1-mini",
+            "retry_resume",
+            "people",
+            {"name": {"type": "string"}},
+            "",
+            "Sergei, Cynthia and Bob",
+            "",
+            "task1",
+        )
+
+    task_info = ds._extract_tasks["task1"]
+    assert task_info["error"] is None
+    assert task_info["retries"] == 1
+    # With no other writers the rows form a single run of rowids
+    assert task_info["rowid_ranges"] == [[1, 3]]
+    assert len(captured_prompts) == 2
+    assert captured_prompts[0] == "Sergei, Cynthia and Bob"
+    # Only the count and the most recent resume_items items are sent back
+    assert "2 items have already been extracted" in captured_prompts[1]
+    assert captured_prompts[1].endswith('[{"name": "Cynthia"}]')
+    rows = (await db.execute("select name from people")).rows
+    assert [row["name"] for row in rows] == ["Sergei", "Cynthia", "Bob"]
+    run = (
+        await db.execute(
+            "select num_items, retries from _datasette_extract where id = 'task1'"
+        )
+    ).first()
+    assert dict(run) == {"num_items": 3, "retries": 1}
+
+
+@pytest.mark.asyncio
+async def test_read_task_items_with_concurrent_tasks():
+    ds = Datasette()
+    ds.add_memory_database("concurrent_tasks")
+
+    def interleaved_stream(name):
+        async def aiter_chunks():
+            yield '{"items": ['
+            for i in range(3):
+                # Give the other task a chance to write in between
+                await asyncio.sleep(0.01)
+                yield '{}{{"name": "{}{}"}}'.format(", " if i else "", name, i)
+            yield "]}"
+
+        response = AsyncMock()
+        response.__aiter__ = lambda self: aiter_chunks()
+        return response
+
+    async def fake_prompt(prompt_text, **kwargs):
+        return interleaved_stream(prompt_text)
+
+    with patch("datasette_llm.LLM.model") as mock_model:
+        wrapped = AsyncMock()
+        wrapped.prompt = fake_prompt
+        mock_model.return_value = wrapped
+        await asyncio.gather(
+            *[
+                extract_table_task(
+                    ds,
+                    "gpt-4.1-mini",
+                    "concurrent_tasks",
+                    "people",
+                    {"name": {"type": "string"}},
+                    "",
+                    name,
+                    "",
+                    "concurrent_{}".format(name),
+                )
+                for name in ("X", "Y")
+            ]
+        )
+
+    for name in ("X", "Y"):
+        task_info = ds._extract_tasks["concurrent_{}".format(name)]
+        assert await read_task_items(ds, task_info, 0, 10) == [
+            {"name": "{}{}".format(name, i)} for i in range(3)
+        ]
+        assert await read_task_items(ds, task_info, 1, 1) == [
+            {"name": "{}1".format(name)}
+        ]
+
+
+@pytest.mark.asyncio
+async def test_write_errors_are_not_retried():
+    ds = Datasette(config={"plugins": {"datasette-extract": {"retry_backoff": 0}}})
+    db = ds.add_memory_database("write_error")
+    await db.execute_write("create table people (name text not null)")
+    calls = []
+
+    async def fake_prompt(prompt_text, **kwargs):
+        calls.append(prompt_text)
+        return fake_stream('{"items": [{"name": null}, {"name": "Cynthia"}]}')
+
+    with patch("datasette_llm.LLM.model") as mock_model:
+        wrapped = AsyncMock()
+        wrapped.prompt = fake_prompt
+        mock_model.return_value = wrapped
+        await extract_table_task(
+            ds,
+            "gpt-4.1-mini",
+            "write_error",
+            "people",
+            {"name": {"type": "string"}},
+            "",
+            "Nobody and Cynthia",
+            "",
+            "write_error1",
+        )
+
+    task_info = ds._extract_tasks["write_error1"]
+    assert "NOT NULL constraint failed" in task_info["error"]
+    assert task_info["retries"] == 0
+    assert task_info["num_items"] == 0
+    assert len(calls) == 1
+    run = (
+        await db.execute(
+            "select error from _datasette_extract where id = 'write_error1'"
+        )
+    ).first()
+    assert "NOT NULL constraint failed" in run["error"]
+
+
+@pytest.mark.asyncio
+async def test_retries_exhausted_records_error():
+    ds = Datasette(
+        config={"plugins": {"datasette-extract": {"retries": 1, "retry_backoff": 0}}}
+    )
+    db = ds.add_memory_database("retry_exhausted")
+
+    async def fake_prompt(prompt_text, **kwargs):
+        return fake_stream(error=ConnectionError("429 Too Many Requests"))
+
+    with patch("datasette_llm.LLM.model") as mock_model:
+        wrapped = AsyncMock()
+        wrapped.prompt = fake_prompt
+        mock_model.return_value = wrapped
+        await extract_table_task(
+            ds,
+            "gpt-4.1-mini",
+            "retry_exhausted",
+            "people",
+            {"name": {"type": "string"}},
+            "",
+            "Sergei",
+            "",
+            "task2",
+        )
+
+    task_info = ds._extract_tasks["task2"]
+    assert task_info["error"] == "429 Too Many Requests"
+    assert task_info["retries"] == 1
+    run = (
+        await db.execute(
+            "select error, retries from _datasette_extract where id = 'task2'"
+        )
+    ).first()
+    assert dict(run) == {"error": "429 Too Many Requests", "retries": 1}
+
+
+@pytest.mark.asyncio
+async def test_batch_mode_local_backend(tmp_path):
+    ds = Datasette(
+        config={
+            "plugins": {
+                "datasette-extract": {
+                    "batch": {
+                        "backend": "local",
+                        "directory": str(tmp_path),
+                        "poll_interval": 0.01,
+                    }
+                }
+            }
+        }
+    )
+    db = ds.add_memory_database("batch_local")
+    task_id = await submit_extract_batch(
+        ds,
+        "gpt-4.1-mini",
+        "batch_local",
+        "people",
+        {"name": {"type": "string"}},
+        "Be nice",
+        ["Sergei and Cynthia", "Bob"],
+    )
+    # Wait a moment for ds._extract_tasks to be populated
+    await asyncio.sleep(0.01)
+    task_info = ds._extract_tasks[task_id]
+    batch_id = task_info["batch_id"]
+    requests = [
+        json.loads(line)
+        for line in (tmp_path / f"{batch_id}.requests.jsonl").read_text().splitlines()
+    ]
+    assert [(r["custom_id"], r["prompt"], r["system"]) for r in requests] == [
+        ("0", "Sergei and Cynthia", "Be nice"),
+        ("1", "Bob", "Be nice"),
+    ]
+    assert requests[0]["schema"]["properties"]["items"]["items"]["properties"] == {
+        "name": {"type": "string"}
+    }
+    # Still pending until the results file shows up
+    await asyncio.sleep(0.05)
+    assert not task_info["done"]
+    (tmp_path / f"{batch_id}.results.jsonl").write_text(
+        json.dumps(
+            {
+                "custom_id": "0",
+                "output": json.dumps(
+                    {"items": [{"name": "Sergei"}, {"name": "Cynthia"}]}
+                ),
+            }
+        )
+        + "\n"
+        + json.dumps(
+            {"custom_id": "1", "output": json.dumps({"items": [{"name": "Bob"}]})}
+        )
+        + "\n"
+    )
+    while not task_info["done"]:
+        await asyncio.sleep(0.01)
+    assert task_info["error"] is None
+    rows = (await db.execute("select name from people")).rows
+    assert [row["name"] for row in rows] == ["Sergei", "Cynthia", "Bob"]
+    run = (
+        await db.execute(
+            "select batch_id, num_items, completed from _datasette_extract where id = ?",
+            [task_id],
+        )
+    ).first()
+    assert run["batch_id"] == batch_id
+    assert run["num_items"] == 3
+    assert run["completed"]
+
+
+@pytest.mark.asyncio
+async def test_batch_inserted_once_by_concurrent_pollers(tmp_path):
+    path = str(tmp_path / "data.db")
+    sqlite_utils.Database(path).vacuum()
+    config = {
+        "plugins": {
+            "datasette-extract": {
+                "batch": {"directory": str(tmp_path), "poll_interval": 0.01}
+            }
+        }
+    }
+    task_id = await submit_extract_batch(
+        Datasette([path], config=config),
+        "gpt-4.1-mini",
+        "data",
+        "people",
+        {"name": {"type": "string"}},
+        "",
+        ["Bob"],
+        poll=False,
+    )
+    # Two web servers sharing the database both resume polling the batch,
+    # command-line instances leave it alone
+    servers = [Datasette([path], config=config) for _ in range(2)]
+    command = Datasette([path], config=config)
+    command._extract_resume_batches = False
+    for ds in servers + [command]:
+        await ds.invoke_startup()
+    await asyncio.sleep(0.05)
+    assert task_id not in (getattr(command, "_extract_tasks", None) or {})
+    batch_id = servers[0]._extract_tasks[task_id]["batch_id"]
+    (tmp_path / f"{batch_id}.results.jsonl").write_text(
+        json.dumps(
+            {"custom_id": "0", "output": json.dumps({"items": [{"name": "Bob"}]})}
+        )
+        + "\n"
+    )
+    while not all(ds._extract_tasks[task_id]["done"] for ds in servers):
+        await asyncio.sleep(0.01)
+    db = sqlite_utils.Database(path)
+    assert list(db["people"].rows) == [{"name": "Bob"}]
+    assert db["_datasette_extract"].get(task_id)["num_items"] == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("fail", (False, True))
+async def test_staging_mode(fail):
+    ds = Datasette(
+        config={
+            "plugins": {
+                "datasette-extract": {"staging": True, "retries": 0},
+            }
+        }
+    )
+    db_name = "staging_fail" if fail else "staging_ok"
+    db = ds.add_memory_database(db_name)
+    tables_mid_stream = []
+
+    async def aiter_chunks():
+        yield '{"items": [{"name": "Sergei"}, {"name": "Cynthia"}, '
+        tables_mid_stream.extend(await db.table_names())
+        if fail:
+            raise ValueError("Bad response")
+        yield '{"name": "Bob"}]}'
+
+    async def fake_prompt(prompt_text, **kwargs):
+        mock_response = AsyncMock()
+        mock_response.__aiter__ = lambda self: aiter_chunks()
+        return mock_response
+
+    with patch("datasette_llm.LLM.model") as mock_model:
+        wrapped = AsyncMock()
+        wrapped.prompt = fake_prompt
+        mock_model.return_value = wrapped
+        await extract_table_task(
+            ds,
+            "gpt-4.1-mini",
+            db_name,
+            "people",
+            {"name": {"type": "string"}},
+            "",
+            "Sergei, Cynthia and Bob",
+            "",
+            "01staging",
+        )
+
+    # Rows were streamed into the staging table, not the target
+    assert "_datasette_extract_staging_01staging" in tables_mid_stream
+    assert "people" not in tables_mid_stream
+    tables = await db.table_names()
+    assert "_datasette_extract_staging_01staging" not in tables
+    if fail:
+        assert ds._extract_tasks["01staging"]["error"] == "Bad response"
+        assert "people" not in tables
+    else:
+        assert ds._extract_tasks["01staging"]["error"] is None
+        rows = (await db.execute("select name from people")).rows
+        assert [row["name"] for row in rows] == ["Sergei", "Cynthia", "Bob"]
+
+
+@pytest.mark.asyncio
+async def test_progress_since():
+    ds = Datasette()
+    ds.add_memory_database("progress_since")
+
+    async def fake_prompt(prompt_text, **kwargs):
+        return fake_stream(
+            '{"items": [{"name": "Sergei"}, {"name": "Cynthia"}, {"name": "Bob"}]}'
+        )
+
+    with patch("datasette_llm.LLM.model") as mock_model:
+        wrapped = AsyncMock()
+        wrapped.prompt = fake_prompt
+        mock_model.return_value = wrapped
+        await extract_table_task(
+            ds,
+            "gpt-4.1-mini",
+            "progress_since",
+            "people",
+            {"name": {"type": "string"}},
+            "",
+            "Sergei, Cynthia and Bob",
+            "",
+            "01since",
+        )
+
+    response = await ds.client.get("/-/extract/progress/01since.json?_since=1")
+    data = response.json()
+    assert data["items"] == [{"name": "Cynthia"}, {"name": "Bob"}]
+    assert data["items_offset"] == 1
+    assert data["num_items"] == 3
+    response = await ds.client.get("/-/extract/progress/01since.json?_since=3")
+    assert response.json()["items"] == []
+    response = await ds.client.get("/-/extract/progress/01since.json?_since=x")
+    assert response.status_code == 400
+    html = (await ds.client.get("/-/extract/progress/01since")).text
+    assert "<th>name</th>" in html
+    assert 'const columns = ["name"];' in html
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("staging", (False, True))
+async def test_bounded_preview_items(monkeypatch, staging):
+    monkeypatch.setattr("datasette_extract.PREVIEW_ITEMS", 2)
+    ds = Datasette(config={"plugins": {"datasette-extract": {"staging": staging}}})
+    db_name = "preview_staging" if staging else "preview"
+    db = ds.add_memory_database(db_name)
+    # Existing rows should not show up in the progress for this task
+    await db.execute_write("create table people (id integer primary key, name text)")
+    await db.execute_write("insert into people (name) values ('Existing')")
+    names = ["Sergei", "Cynthia", "Bob", "Alice", "Eve"]
+
+    async def fake_prompt(prompt_text, **kwargs):
+        return fake_stream(json.dumps({"items": [{"name": name} for name in names]}))
+
+    with patch("datasette_llm.LLM.model") as mock_model:
+        wrapped = AsyncMock()
+        wrapped.prompt = fake_prompt
+        mock_model.return_value = wrapped
+        await extract_table_task(
+            ds,
+            "gpt-4.1-mini",
+            db_name,
+            "people",
+            {"name": {"type": "string"}},
+            "",
+            "Five names",
+            "",
+            "01preview",
+        )
+
+    task_info = ds._extract_tasks["01preview"]
+    assert task_info["items"] == [{"name": "Alice"}, {"name": "Eve"}]
+    assert task_info["num_items"] == 5
+    # Older items are read back from the table
+    response = await ds.client.get("/-/extract/progress/01preview.json?_since=0")
+    assert response.json()["items"] == [{"name": name} for name in names]
+    response = await ds.client.get("/-/extract/progress/01preview.json?_since=2")
+    assert response.json()["items"] == [{"name": name} for name in names[2:]]
+    response = await ds.client.get("/-/extract/progress/01preview.json?_since=4")
+    assert response.json()["items"] == [{"name": "Eve"}]
+
+
+@pytest.mark.parametrize(
+    "step,input,expected",
+    (
+        ("whitespace", "  a   b\t\tc  \n\n\n\nd  ", "a b c\n\nd"),
+        (
+            "quoted_text",
+            "Yes, 3 please\nOn Mon, Jan 1, 2024 Bob wrote:\n> How many?\n>> Hi",
+            "Yes, 3 please",
+        ),
+        (
+            "boilerplate",
+            "Order: 5\nPage 1 of 2\nSent from my iPhone\n-- \nBob\nCEO",
+            "Order: 5",
+        ),
+        (
+            # A bare "--" is data, not a signature delimiter
+            "boilerplate",
+            "Item: A\nPrice: --\n--\nItem: B\nNote: do not unsubscribe me",
+            "Item: A\nPrice: --\n--\nItem: B\nNote: do not unsubscribe me",
+        ),
+        (
+            # A "-- " line is only a signature close to the end of the text
+            "boilerplate",
+            "-- \n" + "\n".join("row {}".format(i) for i in range(12)),
+            "-- \n" + "\n".join("row {}".format(i) for i in range(12)),
+        ),
+        (
+            "boilerplate",
+            "Total: 5\nUnsubscribe from these emails\nClick here to unsubscribe",
+            "Total: 5",
+        ),
+        (
+            "repeated_lines",
+            "\n".join(["ACME Report", "row 1", "row 1", "row 2", "row 3", "row 4"] * 3),
+            "\n".join(
+                ["ACME Report", "row 1", "row 1", "row 2", "row 3", "row 4"]
+                + ["row 1", "row 1", "row 2", "row 3", "row 4"] * 2
+            ),
+        ),
+        (
+            # Repeated data is kept: short cell values and identical line items
+            "repeated_lines",
+            "Yes\n1\nYes\n1\nYes\n1\n"
+            + "Widget x1 2.50\nWidget x1 2.50\nWidget x1 2.50",
+            "Yes\n1\nYes\n1\nYes\n1\n"
+            + "Widget x1 2.50\nWidget x1 2.50\nWidget x1 2.50",
+        ),
+    ),
+)
+def test_preprocess_steps(step, input, expected):
+    output, stats = preprocess_content(input, [step])
+    assert output == expected
+    assert stats == [
+        {
+            "step": step,
+            "bytes_saved": len(input) - len(expected),
+            "tokens_saved": (len(input) + 3) // 4 - (len(expected) + 3) // 4,
+        }
+    ]
+
+
+@pytest.mark.asyncio
+async def test_preprocessing_before_prompt():
+    ds = Datasette(
+        config={
+            "plugins": {
+                "datasette-extract": {
+                    "preprocess": ["quoted_text", "whitespace"],
+                }
+            }
+        }
+    )
+    db = ds.add_memory_database("preprocess")
+    captured_prompts = []
+
+    async def fake_prompt(prompt_text, **kwargs):
+        captured_prompts.append(prompt_text)
+        return fake_stream('{"items": []}')
+
+    with patch("datasette_llm.LLM.model") as mock_model:
+        wrapped = AsyncMock()
+        wrapped.prompt = fake_prompt
+        mock_model.return_value = wrapped
+        await extract_table_task(
+            ds,
+            "gpt-4.1-mini",
+            "preprocess",
+            "people",
+            {"name": {"type": "string"}},
+            "",
+            "Sergei   is 4\n\n\n\nOn Monday Bob wrote:\n> Cynthia is 7",
+            "",
+            "01preprocess",
+        )
+
+    assert captured_prompts == ["Sergei is 4"]
+    stats = ds._extract_tasks["01preprocess"]["preprocessing"]
+    assert [stat["step"] for stat in stats] == ["quoted_text", "whitespace"]
+    assert all(stat["bytes_saved"] > 0 for stat in stats)
+    run = (
+        await db.execute(
+            "select preprocessing from _datasette_extract where id = '01preprocess'"
+        )
+    ).first()
+    assert json.loads(run["preprocessing"]) == stats
+
+
+@pytest.mark.asyncio
+async def test_archive_output_and_replay():
+    ds = Datasette(
+        config={
+            "plugins": {"datasette-extract": {"archive_output": True, "retries": 0}}
+        }
+    )
+    ds.root_enabled = True
+    db = ds.add_memory_database("replay")
+    # Table is missing the age column, so writing the rows will fail
+    await db.execute_write("create table people (name text)")
+
+    async def fake_prompt(prompt_text, **kwargs):
+        return fake_stream(
+            '{"items": [{"name": "Sergei", "age": 4}, ',
+            '{"name": "Cynthia", "age": 7}]}',
+        )
+
+    with patch("datasette_llm.LLM.model") as mock_model:
+        wrapped = AsyncMock()
+        wrapped.prompt = fake_prompt
+        mock_model.return_value = wrapped
+        await extract_table_task(
+            ds,
+            "gpt-4.1-mini",
+            "replay",
+            "people",
+            {"name": {"type": "string"}, "age": {"type": "integer"}},
+            "",
+            "Sergei is 4, Cynthia is 7",
+            "",
+            "01archived",
+        )
+    assert "no column named age" in ds._extract_tasks["01archived"]["error"]
+
+    cookies = {"ds_actor": ds.client.actor_cookie({"id": "root"})}
+    response = await ds.client.get("/replay/people/-/extract", cookies=cookies)
+    assert 'action="/replay/-/extract/replay/01archived"' in response.text
+    cookies["ds_csrftoken"] = response.cookies["ds_csrftoken"]
+
+    with patch("datasette_llm.LLM.model") as mock_model:
+        post_response = await ds.client.post(
+            "/replay/-/extract/replay/01archived",
+            data={"table": "people_ages", "csrftoken": cookies["ds_csrftoken"]},
+            cookies=cookies,
+        )
+        assert post_response.status_code == 302
+        task_id = post_response.headers["location"].split("/")[-1]
+        while not ds._extract_tasks.get(task_id, {}).get("done"):
+            await asyncio.sleep(0.01)
+        # Replaying should not call the model
+        assert not mock_model.called
+
+    task_info = ds._extract_tasks[task_id]
+    assert task_info["error"] is None
+    assert task_info["replay_of"] == "01archived"
+    rows = (await db.execute("select name, age from people_ages")).rows
+    assert [dict(row) for row in rows] == [
+        {"name": "Sergei", "age": 4},
+        {"name": "Cynthia", "age": 7},
+    ]
+
+    # Runs without archived output cannot be replayed
+    response = await ds.client.post(
+        "/replay/-/extract/replay/missing",
+        data={"csrftoken": cookies["ds_csrftoken"]},
+        cookies=cookies,
+    )
+    assert response.status_code == 404
+
+    # Anonymous users cannot tell which runs exist
+    for run_id in ("01archived", "missing"):
+        response = await ds.client.post(
+            "/replay/-/extract/replay/{}".format(run_id),
+            data={"csrftoken": cookies["ds_csrftoken"]},
+            cookies={"ds_csrftoken": cookies["ds_csrftoken"]},
+        )
+        assert response.status_code == 403
+
+
+ROUTING_RULES = [
+    {"model": "small", "max_length": 100, "max_properties": 3, "image": False},
+    {"model": "vision", "image": True},
+    {"model": "missing"},
+    {"model": "large", "min_length": 50},
+]
+
+
+@pytest.mark.parametrize(
+    "length,has_image,num_properties,expected_model,expected_rule",
+    (
+        (20, False, 2, "small", 0),
+        (80, False, 5, "large", 3),
+        (20, True, 2, "vision", 1),
+        (500, False, 2, "large", 3),
+        # No rules match, so use the first available model
+        (20, False, 5, "small", None),
+    ),
+)
+def test_route_model(length, has_image, num_properties, expected_model, expected_rule):
+    rules = ROUTING_RULES
+    if expected_rule is None:
+        rules = ROUTING_RULES[:3]
+    model_id, decision = route_model(
+        rules, ["small", "vision", "large"], length, has_image, num_properties
+    )
+    assert model_id == expected_model
+    assert decision == {
+        "length": length,
+        "image": has_image,
+        "properties": num_properties,
+        "rule": expected_rule,
+    }
+
+
+@pytest.mark.asyncio
+async def test_automatic_model_routing():
+    ds = Datasette(
+        config={
+            "plugins": {
+                "datasette-extract": {
+                    "routing": [
+                        {"model": "gpt-4.1-nano", "max_length": 100},
+                        {"model": "gpt-4.1"},
+                    ]
+                }
+            }
+        }
+    )
+    ds.root_enabled = True
+    db = ds.add_memory_database("routing")
+    cookies = {"ds_actor": ds.client.actor_cookie({"id": "root"})}
+    response = await ds.client.get("/routing/-/extract", cookies=cookies)
+    assert '<option value="auto">' in response.text
+    cookies["ds_csrftoken"] = response.cookies["ds_csrftoken"]
+
+    models_used = []
+
+    async def fake_model(model_id, **kwargs):
+        models_used.append(model_id)
+        wrapped = AsyncMock()
+
+        async def fake_prompt(prompt_text, **kwargs):
+            return fake_stream('{"items": []}')
+
+        wrapped.prompt = fake_prompt
+        return wrapped
+
+    with patch("datasette_llm.LLM.model", side_effect=fake_model):
+        for table, content in (("short", "Sergei is 4"), ("long", "Cynthia " * 50)):
+            response = await ds.client.post(
+                "/routing/-/extract",
+                data={
+                    "table": table,
+                    "content": content,
+                    "csrftoken": cookies["ds_csrftoken"],
+                    "name_0": "name",
+                    "type_0": "string",
+                    "model": "auto",
+                },
+                cookies=cookies,
+            )
+            assert response.status_code == 302
+        await asyncio.sleep(0.2)
+
+    assert models_used == ["gpt-4.1-nano", "gpt-4.1"]
+    runs = (
+        await db.execute(
+            "select table_name, model, routing from _datasette_extract order by id"
+        )
+    ).rows
+    assert [(run["table_name"], run["model"]) for run in runs] == [
+        ("short", "gpt-4.1-nano"),
+        ("long", "gpt-4.1"),
+    ]
+    assert json.loads(runs[0]["routing"]) == {
+        "length": 11,
+        "image": False,
+        "properties": 1,
+        "rule": 0,
+    }
+    assert json.loads(runs[1]["routing"])["rule"] == 1
+
+
+@pytest.mark.asyncio
+async def test_nested_extraction_writes_child_table():
+    ds = Datasette()
+    db = ds.add_memory_database("nested_invoices")
+    properties = {
+        "number": {"type": "string"},
+        "line_items": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "description": {"type": "string"},
+                    "amount": {"type": "number"},
+                },
+            },
+        },
+        "total": {"type": "number"},
+    }
+    mid_stream = {}
+
+    async def aiter_chunks():
+        yield '{"items": [{"number": "INV-1", "line_items": ['
+        yield '{"description": "Widget", "amount": 2.5}, '
+        # The first line item is written before the invoice has finished
+        mid_stream["line_items"] = (
+            await db.execute("select description from line_items")
+        ).rows
+        yield '{"description": "Gadget", "amount": 4}], "total": 6.5}, '
+        yield '{"number": "INV-2", "line_items": [], "total": 0}]}'
+
+    response = AsyncMock()
+    response.__aiter__ = lambda self: aiter_chunks()
+
+    with patch("datasette_llm.LLM.model") as mock_model:
+        wrapped = AsyncMock()
+        wrapped.prompt.return_value = response
+        mock_model.return_value = wrapped
+        await extract_table_task(
+            ds,
+            "gpt-4.1-mini",
+            "nested_invoices",
+            "invoices",
+            properties,
+            "",
+            "Two invoices",
+            "",
+            "nested1",
+        )
+
+    task_info = ds._extract_tasks["nested1"]
+    assert task_info["error"] is None
+    assert task_info["num_items"] == 2
+    assert task_info["num_child_items"] == {"line_items": 2}
+    assert [row["description"] for row in mid_stream["line_items"]] == ["Widget"]
+    invoices = (await db.execute("select id, number, total from invoices")).rows
+    assert [dict(row) for row in invoices] == [
+        {"id": 1, "number": "INV-1", "total": 6.5},
+        {"id": 2, "number": "INV-2", "total": 0},
+    ]
+    line_items = (
+        await db.execute("select description, amount, invoices_id from line_items")
+    ).rows
+    assert [dict(row) for row in line_items] == [
+        {"description": "Widget", "amount": 2.5, "invoices_id": 1},
+        {"description": "Gadget", "amount": 4, "invoices_id": 1},
+    ]
+    foreign_keys = await db.execute_fn(
+        lambda conn: Database(conn)["line_items"].foreign_keys
+    )
+    assert [(fk.column, fk.other_table, fk.other_column) for fk in foreign_keys] == [
+        ("invoices_id", "invoices", "id")
+    ]
+    # The progress page reads rows back without the child array column
+    assert await read_task_items(ds, task_info, 0, 10) == [
+        {"number": "INV-1", "total": 6.5},
+        {"number": "INV-2", "total": 0},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_nested_extraction_retry_and_replay():
+    ds = Datasette(
+        config={
+            "plugins": {
+                "datasette-extract": {"archive_output": True, "retry_backoff": 0}
+            }
+        }
+    )
+    db = ds.add_memory_database("nested_orders")
+    properties = {
+        "customer": {"type": "string"},
+        "lines": {
+            "type": "array",
+            "items": {"type": "object", "properties": {"sku": {"type": "string"}}},
+        },
+    }
+    full_output = (
+        '{"items": [{"customer": "Acme", "lines": [{"sku": "A1"}]}, '
+        '{"customer": "Acme", "lines": [{"sku": "B2"}, {"sku": "C3"}]}]}'
+    )
+    captured_prompts = []
+    responses = [
+        fake_stream(
+            full_output[: full_output.index("B2") + 4],
+            error=ConnectionError("Connection dropped"),
+        ),
+        fake_stream(full_output),
+    ]
+
+    async def fake_prompt(prompt_text, **kwargs):
+        captured_prompts.append(prompt_text)
+        return responses.pop(0)
+
+    with patch("datasette_llm.LLM.model") as mock_model:
+        wrapped = AsyncMock()
+        wrapped.prompt = fake_prompt
+        mock_model.return_value = wrapped
+        await extract_table_task(
+            ds,
+            "gpt-4.1-mini",
+            "nested_orders",
+            "orders",
+            properties,
+            "",
+            "Two orders from Acme",
+            "",
+            "nested_retry",
+        )
+
+    task_info = ds._extract_tasks["nested_retry"]
+    assert task_info["error"] is None
+    assert task_info["retries"] == 1
+    # The retry starts over, skipping the order that was already written
+    assert captured_prompts == ["Two orders from Acme", "Two orders from Acme"]
+    assert task_info["num_items"] == 2
+    assert task_info["num_child_items"] == {"lines": 3}
+
+    expected_orders = [
+        {"id": 1, "customer": "Acme"},
+        {"id": 2, "customer": "Acme"},
+    ]
+    expected_lines = [
+        {"sku": "A1", "orders_id": 1},
+        {"sku": "B2", "orders_id": 2},
+        {"sku": "C3", "orders_id": 2},
+    ]
+    rows = (await db.execute("select id, customer from orders")).rows
+    assert [dict(row) for row in rows] == expected_orders
+    rows = (await db.execute("select sku, orders_id from lines order by id")).rows
+    assert [dict(row) for row in rows] == expected_lines
+
+    # Replaying the archived output writes the child rows in the same way
+    await db.execute_write("drop table lines")
+    await replay_extract_output(
+        ds, "nested_orders", "nested_retry", "orders", "nested_replay"
+    )
+    task_info = ds._extract_tasks["nested_replay"]
+    assert task_info["error"] is None
+    assert task_info["num_items"] == 2
+    assert task_info["num_child_items"] == {"lines": 3}
+    rows = (await db.execute("select id, customer from orders")).rows
+    assert [dict(row) for row in rows] == expected_orders + [
+        {"id": 3, "customer": "Acme"},
+        {"id": 4, "customer": "Acme"},
+    ]
+    rows = (await db.execute("select sku, orders_id from lines order by id")).rows
+    assert [dict(row) for row in rows] == [
+        {"sku": "A1", "orders_id": 3},
+        {"sku": "B2", "orders_id": 4},
+        {"sku": "C3", "orders_id": 4},
+    ]
+    assert await read_task_items(ds, task_info, 0, 10) == [
+        {"customer": "Acme"},
+        {"customer": "Acme"},
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "output,expected_parents,expected_fks",
+    (
+        # Child arrays before any other fields, or with no other fields at all
+        (
+            '{"items": [{"lines": [{"sku": "A1"}], "customer": "Acme"}, '
+            '{"lines": [{"sku": "B2"}]}]}',
+            [{"customer": "Acme"}, {"customer": None}],
+            [("parents_id", "parents", "id")],
+        ),
+        # An id extracted by the model is kept as a regular column
+        (
+            '{"items": [{"id": "INV-1", "lines": [{"sku": "A1"}]}, '
+            '{"id": "INV-1", "lines": [{"sku": "B2"}]}]}',
+            [{"id": "INV-1"}, {"id": "INV-1"}],
+            [],
+        ),
+    ),
+)
+async def test_nested_extraction_parent_fields(output, expected_parents, expected_fks):
+    ds = Datasette()
+    db_name = "nested_parent_{}".format(len(expected_fks))
+    db = ds.add_memory_database(db_name)
+    first = expected_parents[0]
+    properties = {
+        next(iter(first)): {"type": "string"},
+        "lines": {
+            "type": "array",
+            "items": {"type": "object", "properties": {"sku": {"type": "string"}}},
+        },
+    }
+    with patch("datasette_llm.LLM.model") as mock_model:
+        wrapped = AsyncMock()
+        wrapped.prompt.return_value = fake_stream(output)
+        mock_model.return_value = wrapped
+        await extract_table_task(
+            ds, "gpt-4.1-mini", db_name, "parents", properties, "", "x", "", "np"
+        )
+    assert ds._extract_tasks["np"]["error"] is None
+    column = next(iter(first))
+    rows = (
+        await db.execute("select {} from parents order by rowid".format(column))
+    ).rows
+    assert [{column: row[column]} for row in rows] == expected_parents
+    rows = (await db.execute("select sku, parents_id from lines order by rowid")).rows
+    assert [tuple(row) for row in rows] == [("A1", 1), ("B2", 2)]
+    foreign_keys = await db.execute_fn(
+        lambda conn: Database(conn)["lines"].foreign_keys
+    )
+    assert [
+        (fk.column, fk.other_table, fk.other_column) for fk in foreign_keys
+    ] == expected_fks
+
+
+@pytest.mark.asyncio
+async def test_child_table_form_errors(tmp_path):
+    ds = Datasette(
+        config={
+            "plugins": {"datasette-extract": {"batch": {"directory": str(tmp_path)}}}
+        }
+    )
+    ds.root_enabled = True
+    ds.add_memory_database("child_form")
+    cookies = {"ds_actor": ds.client.actor_cookie({"id": "root"})}
+    response = await ds.client.get("/child_form/-/extract", cookies=cookies)
+    cookies["ds_csrftoken"] = response.cookies["ds_csrftoken"]
+    data = {
+        "table": "invoices",
+        "content": "Invoices",
+        "csrftoken": cookies["ds_csrftoken"],
+        "name_0": "number",
+        "type_0": "string",
+        "model": "gpt-4.1-mini",
+        "child_table": "line_items",
+        "child_name_0": "description",
+        "child_type_0": "string",
+    }
+    response = await ds.client.post(
+        "/child_form/-/extract", data=dict(data, name_0="id"), cookies=cookies
+    )
+    assert response.status_code == 400
+    assert "The id column is used to link to the child table" in response.text
+    response = await ds.client.post(
+        "/child_form/-/extract", data=dict(data, mode="batch"), cookies=cookies
+    )
+    assert response.status_code == 400
+    assert response.text == "Child tables are not supported in batch mode"
@@ -0,0 +1,242 @@
+import asyncio
+import json
+from click.testing import CliRunner
+from datasette.app import Datasette
+from datasette.cli import cli
+from datasette_extract import enqueue_extract_job, run_extract_worker, utc_now
+import pytest
+import sqlite_utils
+from unittest.mock import AsyncMock, patch
+
+
+def mock_model(*chunks):
+    async def aiter_chunks():
+        for chunk in chunks:
+            yield chunk
+
+    async def fake_prompt(prompt_text, **kwargs):
+        mock_response = AsyncMock()
+        mock_response.__aiter__ = lambda self: aiter_chunks()
+        return mock_response
+
+    wrapped = AsyncMock()
+    wrapped.prompt = fake_prompt
+    return wrapped
+
+
+@pytest.mark.asyncio
+async def test_queued_job_run_by_worker(tmp_path):
+    path = str(tmp_path / "data.db")
+    sqlite_utils.Database(path).vacuum()
+    config = {"plugins": {"datasette-extract": {"queue": True}}}
+    web = Datasette([path], config=config)
+    await enqueue_extract_job(
+        web,
+        "gpt-4.1-mini",
+        "data",
+        "people",
+        {"name": {"type": "string"}},
+        "",
+        "Sergei and Cynthia",
+        None,
+        "01job",
+    )
+    progress = (await web.client.get("/-/extract/progress/01job.json")).json()
+    assert progress["status"] == "queued"
+    assert not progress["done"]
+
+    # A separate Datasette instance, as if in another process
+    worker = Datasette([path], config=config)
+    with patch("datasette_llm.LLM.model") as model:
+        model.return_value = mock_model(
+            '{"items": [{"name": "Sergei"}, {"name": "Cynthia"}]}'
+        )
+        await run_extract_worker(worker, once=True)
+
+    progress = (await web.client.get("/-/extract/progress/01job.json")).json()
+    assert progress == {
+        "items": [{"name": "Sergei"}, {"name": "Cynthia"}],
+        "database": "data",
+        "model": "gpt-4.1-mini",
+        "table": "people",
+        "instructions": "",
+        "properties": {"name": {"type": "string"}},
+        "error": None,
+        "retries": 0,
+        "status": "done",
+        "num_items": 2,
+        "done": True,
+    }
+    db = sqlite_utils.Database(path)
+    assert list(db["people"].rows) == [{"name": "Sergei"}, {"name": "Cynthia"}]
+    assert db["_datasette_extract"].get("01job")["num_items"] == 2
+
+
+@pytest.mark.asyncio
+async def test_queued_job_progress_since(tmp_path):
+    path = str(tmp_path / "data.db")
+    sqlite_utils.Database(path).vacuum()
+    config = {"plugins": {"datasette-extract": {"queue": True}}}
+    web = Datasette([path], config=config)
+    await enqueue_extract_job(
+        web,
+        "gpt-4.1-mini",
+        "data",
+        "numbers",
+        {"n": {"type": "integer"}},
+        "",
+        "Thirty numbers",
+        None,
+        "01since",
+    )
+    worker = Datasette([path], config=config)
+    with patch("datasette_llm.LLM.model") as model:
+        model.return_value = mock_model(
+            json.dumps({"items": [{"n": n} for n in range(30)]})
+        )
+        await run_extract_worker(worker, once=True)
+
+    # Only the most recent items are kept on the job, so start from those
+    progress = (
+        await web.client.get("/-/extract/progress/01since.json?_since=0")
+    ).json()
+    assert progress["num_items"] == 30
+    assert progress["items_offset"] == 10
+    assert progress["items"] == [{"n": n} for n in range(10, 30)]
+    progress = (
+        await web.client.get("/-/extract/progress/01since.json?_since=25")
+    ).json()
+    assert progress["items_offset"] == 25
+    assert progress["items"] == [{"n": n} for n in range(25, 30)]
+
+
+def test_extract_worker_command(tmp_path):
+    path = str(tmp_path / "data.db")
+    sqlite_utils.Database(path).vacuum()
+    asyncio.run(
+        enqueue_extract_job(
+            Datasette([path]),
+            "gpt-4.1-mini",
+            "data",
+            "people",
+            {"name": {"type": "string"}},
+            "",
+            "Bob",
+            None,
+            "01cli",
+        )
+    )
+    with patch("datasette_llm.LLM.model") as model:
+        model.return_value = mock_model('{"items": [{"name": "Bob"}]}')
+        result = CliRunner().invoke(cli, ["extract-worker", path, "--once"])
+    assert result.exit_code == 0, result.output
+    db = sqlite_utils.Database(path)
+    assert list(db["people"].rows) == [{"name": "Bob"}]
+    job = db["_datasette_extract_jobs"].get("01cli")
+    assert job["status"] == "done"
+    assert job["worker"].startswith("worker-")
+
+
+@pytest.mark.asyncio
+async def test_worker_reclaims_expired_job(tmp_path):
+    path = str(tmp_path / "data.db")
+    sqlite_utils.Database(path).vacuum()
+    config = {"plugins": {"datasette-extract": {"queue": True, "job_lease": 30}}}
+    web = Datasette([path], config=config)
+    for task_id in ("01dead", "01live"):
+        await enqueue_extract_job(
+            web,
+            "gpt-4.1-mini",
+            "data",
+            "people",
+            {"name": {"type": "string"}},
+            "",
+            "Bob",
+            None,
+            task_id,
+        )
+    db = sqlite_utils.Database(path)
+    # One worker died a while ago, another is still busy with its job
+    db["_datasette_extract_jobs"].update(
+        "01dead",
+        {"status": "running", "worker": "dead", "heartbeat": "2020-01-01 00:00:00"},
+    )
+    db["_datasette_extract_jobs"].update(
+        "01live", {"status": "running", "worker": "live", "heartbeat": utc_now()}
+    )
+    # Rows the dead worker wrote before it died
+    db["_datasette_extract_staging_01dead"].insert({"name": "Partial"})
+    worker = Datasette([path], config=config)
+    with patch("datasette_llm.LLM.model") as model:
+        model.return_value = mock_model('{"items": [{"name": "Bob"}]}')
+        await run_extract_worker(worker, worker_id="new", once=True)
+    dead = db["_datasette_extract_jobs"].get("01dead")
+    assert (dead["status"], dead["worker"]) == ("done", "new")
+    live = db["_datasette_extract_jobs"].get("01live")
+    assert (live["status"], live["worker"]) == ("running", "live")
+    assert list(db["people"].rows) == [{"name": "Bob"}]
+    assert not db["_datasette_extract_staging_01dead"].exists()
+
+
+@pytest.mark.asyncio
+async def test_reclaimed_child_table_job_is_not_rerun(tmp_path):
+    path = str(tmp_path / "data.db")
+    sqlite_utils.Database(path).vacuum()
+    config = {"plugins": {"datasette-extract": {"queue": True}}}
+    web = Datasette([path], config=config)
+    properties = {
+        "number": {"type": "string"},
+        "lines": {
+            "type": "array",
+            "items": {"type": "object", "properties": {"sku": {"type": "string"}}},
+        },
+    }
+    await enqueue_extract_job(
+        web, "gpt-4.1-mini", "data", "invoices", properties, "", "x", None, "01nest"
+    )
+    db = sqlite_utils.Database(path)
+    db["_datasette_extract_jobs"].update(
+        "01nest",
+        {
+            "status": "running",
+            "claimed": "2020-01-01 00:00:00",
+            "heartbeat": "2020-01-01 00:00:00",
+        },
+    )
+    worker = Datasette([path], config=config)
+    with patch("datasette_llm.LLM.model") as model:
+        await run_extract_worker(worker, once=True)
+        assert not model.called
+    job = db["_datasette_extract_jobs"].get("01nest")
+    assert job["status"] == "error"
+    assert "cannot be re-run" in job["error"]
+    assert not db["invoices"].exists()
+
+
+@pytest.mark.asyncio
+async def test_job_marked_as_error_if_task_raises(tmp_path):
+    path = str(tmp_path / "data.db")
+    sqlite_utils.Database(path).vacuum()
+    config = {"plugins": {"datasette-extract": {"queue": True}}}
+    web = Datasette([path], config=config)
+    await enqueue_extract_job(
+        web,
+        "gpt-4.1-mini",
+        "data",
+        "people",
+        {"name": {"type": "string"}},
+        "",
+        "Bob",
+        None,
+        "01crash",
+    )
+    worker = Datasette([path], config=config)
+    with patch(
+        "datasette_extract.extract_table_task",
+        AsyncMock(side_effect=RuntimeError("Disk full")),
+    ):
+        await run_extract_worker(worker, once=True)
+    progress = (await web.client.get("/-/extract/progress/01crash.json")).json()
+    assert progress["status"] == "error"
+    assert progress["error"] == "Disk full"
+    assert progress["done"]